@@ -3,12 +3,93 @@
 This tool enables to query MTECapi and can act as demo on how to use the API
 (c) 2023 by Christian Rödel 
 """
-from config import cfg
-import json
+from config import cfg, init_logging
 import datetime
-from dateutil.relativedelta import relativedelta
+import threading
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import MTECapi
 
+#-----------------------------
+class CachedAPI:
+  # Wraps MTECapi with a session cache: results are kept for <ttl> seconds (historical data forever),
+  # queries can be prefetched in the background, and concurrent requests for the same data are merged.
+  LIVE_TTL = 30
+
+  def __init__( self, api, workers=4 ):
+    self.api = api
+    self._cache = {}    # key -> (future, expiry timestamp or None)
+    self._lock = threading.Lock()
+    self._executor = ThreadPoolExecutor( max_workers=workers )
+
+  def _submit( self, key, ttl, func, *args ):
+    now = datetime.datetime.now().timestamp()
+    with self._lock:
+      entry = self._cache.get( key )
+      if entry and (entry[1] is None or entry[1] > now) and not (entry[0].done() and self._failed(entry[0])):
+        return entry[0]   # cached, in flight or successful (failed results are not cached)
+      future = self._executor.submit( func, *args )
+      self._cache[key] = ( future, None if ttl is None else now + ttl )
+      return future
+
+  @staticmethod
+  def _failed( future ):
+    # raised an exception or returned no data
+    return future.exception() is not None or not future.result()
+
+  def _get( self, key, ttl, func, *args ):
+    return self._submit( key, ttl, func, *args ).result()
+
+  def lookup_direction( self, direction ):
+    return self.api.lookup_direction( direction )
+
+  def getStations( self ):
+    return self._get( ("stations",), None, self.api.getStations )
+
+  def getDevices( self, stationId ):
+    return self._get( ("devices", stationId), None, self.api.getDevices, stationId )
+
+  def query_station_data( self, stationId ):
+    return self._get( ("station", stationId), self.LIVE_TTL, self.api.query_station_data, stationId )
+
+  def query_device_data( self, deviceId ):
+    return self._get( ("device", deviceId), self.LIVE_TTL, self.api.query_device_data, deviceId )
+
+  def _usage_key_ttl( self, stationId, durationType, date ):
+    # data of completed days/months doesn't change any more
+    today = datetime.datetime.now()
+    if durationType == "day":
+      key_date = date.strftime("%Y-%m-%d")
+      final = date.date() < today.date()
+    else:
+      key_date = date.strftime("%Y-%m")
+      final = (date.year, date.month) < (today.year, today.month)
+    return ("usage", stationId, durationType, key_date), (None if final else self.LIVE_TTL)
+
+  def query_usage_data( self, stationId, durationType, date ):
+    key, ttl = self._usage_key_ttl( stationId, durationType, date )
+    return self._get( key, ttl, self.api.query_usage_data, stationId, durationType, date )
+
+  def query_usage_data_range( self, stationId, durationType, dates ):
+    # fetch data for all dates concurrently (showing progress); returns results in order of dates
+    futures = []
+    for date in dates:
+      key, ttl = self._usage_key_ttl( stationId, durationType, date )
+      futures.append( self._submit(key, ttl, self.api.query_usage_data, stationId, durationType, date) )
+    done = 0
+    for future in futures:
+      future.result()
+      done += 1
+      print( "\rFetching data: {}/{}".format(done, len(futures)), end="", file=sys.stderr, flush=True )
+    print( file=sys.stderr )
+    return [ future.result() for future in futures ]
+
+  def prefetch_station( self, stationId ):
+    # fetch live data of the station and its devices in the background
+    self._submit( ("station", stationId), self.LIVE_TTL, self.api.query_station_data, stationId )
+    for device_id, _ in self.getDevices( stationId ):
+      self._submit( ("device", device_id), self.LIVE_TTL, self.api.query_device_data, device_id )
+
 #-----------------------------
 def let_user_select_station( api ):
   # Display list of available stations
@@ -23,6 +104,7 @@ def let_user_select_station( api ):
     print("Invalid #")
     return 
   else:
+    api.prefetch_station( stations[i][0] )
     return stations[i][0]
 
 #-----------------------------
@@ -88,6 +170,7 @@ def show_device_data( api ):
   deviceId = let_user_select_device( api, stationId )
   data = api.query_device_data( deviceId )
   if data: 
+    import json
     print( "--------------------------------------------------------" )
     print( json.dumps(data, indent=2) )
 
@@ -97,41 +180,41 @@ def show_usage_data_day( api ):
   days = int(input("Select no. of days you want to export: "))
 
   end_date = datetime.datetime.now()
-  date = end_date - datetime.timedelta(days=days)
+  dates = [ end_date - datetime.timedelta(days=i) for i in range(days, -1, -1) ]
+  results = api.query_usage_data_range( stationId, "day", dates )
   print( "--------------------------------------------------------" )
   print( "timestamp, load, grid, PV, battery, SOC")
 
-  while date <= end_date:
-    data = api.query_usage_data( stationId, "day", date )
+  for data in results:
     if data: 
       for item in data:
         print( "{}, {}, {}, {}, {}, {}".format( item["ts"], item["load"], item["grid"], 
                                              item["PV"], item["battery"], item["SOC"] ) )
-    date += datetime.timedelta(days=1)
 
 #-----------------------------
 def show_usage_data_month( api ):
+  from dateutil.relativedelta import relativedelta
   stationId = let_user_select_station( api )
   months = int(input("Select no. of months you want to export: "))
 
   today = datetime.datetime.now()
   end_date = datetime.datetime( today.year, today.month, 1 )
-  date = end_date - datetime.timedelta(days=(months-1)*30)
+  dates = [ end_date - relativedelta(months=i) for i in range(months-1, -1, -1) ]
+  results = api.query_usage_data_range( stationId, "month", dates )
   print( "--------------------------------------------------------" )
   print( "date, load, pv_production, grid_load, grid_feed, battery_load, battery_feed")
 
-  while date <= end_date:
-    data = api.query_usage_data( stationId, "month", date )
+  for data in results:
     if data: 
       for item in data:
         print( "{}, {}, {}, {}, {}, {}, {}".format( item["date"], item["load"], item["pv_production"],
                                               item["grid_load"], item["grid_feed"], 
                                               item["battery_load"], item["battery_feed"] ) )
-    date += relativedelta(months=1)
 
 #-------------------------------
 def main():
-  api = MTECapi.MTECapi()
+  init_logging()
+  api = CachedAPI( MTECapi.MTECapi() )
 
   while True:
     print( "-------------------------------------" )
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Long-running service for M-TEC Energybutler.
+Hosts the MQTT poller and the scheduled data export jobs on one shared MTECapi instance.
+(c) 2023 by Christian Rödel
+"""
+from config import cfg, BASE_DIR, init_logging
+import MTECapi
+import MTEC_mqtt
+import export_data
+import MTEC_http
+import gaps
+import units
+from scheduler import Scheduler
+from livecache import LiveCache
+from history import MTEChistory
+from topology import TopologyWatcher
+import logging
+import threading
+import signal
+import datetime
+import glob
+import os
+
+#-----------------------------
+def _path( name ):
+  # paths in config.yaml are relative to the installation directory
+  return os.path.join( BASE_DIR, name )
+
+#-----------------------------
+def lookup_station( api ):
+  stations = api.getStations()
+  if cfg.get('EXPORT_STATION'):
+    for station_id, station_data in stations:
+      if station_data['name'] == cfg['EXPORT_STATION']:
+        return station_id
+    logging.error("Unknown station: '{}'".format(cfg['EXPORT_STATION']))
+    return None
+  return stations[0][0] if stations else None
+
+#-----------------------------
+def concat_csv( fname, header_file, files ):
+  # concatenate CSV files (skipping their header lines) to one file
+  with open(header_file, 'r') as f:
+    header = f.readline()
+  with open(fname, 'w') as out:
+    out.write( header )
+    for fn in sorted(files):
+      with open(fn, 'r') as f:
+        f.readline()
+        out.writelines( f )
+
+#-----------------------------
+def task_daily_export( api, history ):
+  # Export data for the whole month until "yesterday" and update year + lifetime files.
+  # Only the month's bar chart data, yesterday's curve and incomplete days are fetched from the portal;
+  # the CSV files are written from the history store.
+  stationId = lookup_station( api )
+  if not stationId:
+    logging.error("No station available for export")
+    return
+  separator = cfg['EXPORT_SEPARATOR']
+  today = datetime.datetime.combine( datetime.date.today(), datetime.time() )
+  yesterday = today - datetime.timedelta(days=1)
+  start_date = yesterday.replace(day=1)
+  start, end = start_date.strftime("%Y-%m-%d"), yesterday.strftime("%Y-%m-%d")
+
+  data = api.query_usage_data( stationId, "month", yesterday )
+  if data:
+    history.store_usage( stationId, "month", data )
+  data = api.query_usage_data( stationId, "day", yesterday )
+  if data is not False:
+    history.store_day( stationId, yesterday, data )
+  if start_date < yesterday:   # incomplete days of the month before yesterday (e.g. daemon was down)
+    gaps.refetch_gaps( api, history, stationId, start, (yesterday - datetime.timedelta(days=1)).strftime("%Y-%m-%d") )
+
+  base_dir = _path( cfg['EXPORT_DATA_DIR'] )
+  data_dir = os.path.join( base_dir, yesterday.strftime("%Y") )
+  os.makedirs( data_dir, exist_ok=True )
+
+  fname_month = os.path.join( data_dir, yesterday.strftime("%Y-%m") + "_month.csv" )
+  with open(fname_month, 'w') as f:
+    print( export_data.USAGE_HEADER, file=f )
+    f.write( export_data.format_usage_data( history.get_usage(stationId, "day", start, end), separator ) )
+  fname_day = os.path.join( data_dir, yesterday.strftime("%Y-%m") + "_day.csv" )
+  with open(fname_day, 'w') as f:
+    print( export_data.DAY_HEADER, file=f )
+    # history stores power in W, the CSV export uses the units of the portal (kW)
+    rows = units.denormalize_rows( history.get_day(stationId, start, end), units.DAY_CURVE_UNITS )
+    f.write( export_data.format_usage_data_day( rows, separator ) )
+
+  # concatenate all month files to a year file, and all year files to a lifetime file
+  fname_year = os.path.join( base_dir, yesterday.strftime("%Y") + "_year.csv" )
+  concat_csv( fname_year, fname_month, glob.glob(os.path.join(data_dir, "*_month.csv")) )
+  fname_lifetime = os.path.join( base_dir, "lifetime.csv" )
+  concat_csv( fname_lifetime, fname_month, glob.glob(os.path.join(base_dir, "*_year.csv")) )
+
+#-----------------------------
+def task_refetch_gaps( api, history ):
+  # re-fetch incomplete days of the last COVERAGE_DAYS days
+  start, end = gaps.default_range()
+  for station_id, _ in api.getStations():
+    gaps.refetch_gaps( api, history, station_id, start, end )
+
+# Tasks which can be scheduled in config.yaml (JOBS)
+TASKS = {
+  "daily_export": task_daily_export,
+  "refetch_gaps": task_refetch_gaps,
+}
+
+#==========================================
+def main():
+  init_logging()
+  if cfg['DEBUG'] == True:
+    logging.getLogger().setLevel(logging.DEBUG)
+  logging.info("Starting")
+
+  stop_event = threading.Event()
+  signal.signal( signal.SIGTERM, lambda signum, frame: stop_event.set() )
+
+  # Inititialization
+  api = MTECapi.MTECapi()
+  cache = LiveCache()
+  shm = None
+  if cfg.get('SHM_ENABLE') == True:
+    # latest values for local readers in other processes (see shmtable.ShmReader)
+    from shmtable import ShmWriter
+    shm = ShmWriter( cfg['SHM_FILE'], cfg.get('SHM_SLOTS', 64), cfg.get('SHM_MAX_VALUES', 64) )
+    cache.add_listener( shm.on_cache_update )
+  history = MTEChistory( _path(cfg['HISTORY_DB']) )
+  scheduler = Scheduler( _path(cfg['DAEMON_STATE_FILE']) )
+  watcher = TopologyWatcher( api )
+  if cfg.get('TOPOLOGY_REFRESH'):
+    # pick up added, removed and renamed stations/devices without restart
+    scheduler.add_job( "refresh_topology", cfg['TOPOLOGY_REFRESH'], watcher.refresh, catchup=False )
+  for name, schedule in (cfg.get('JOBS') or {}).items():
+    if name not in TASKS:
+      logging.error("Unknown job '{}' - ignoring. Available jobs: {}".format(name, ", ".join(TASKS)))
+      continue
+    scheduler.add_job( name, schedule, lambda task=TASKS[name]: task(api, history) )
+
+  mqttclient = None
+  poller = None
+  if cfg['DAEMON_MQTT'] == True:
+    mqttclient = MTEC_mqtt.mqtt_start()
+  if cfg['DAEMON_MQTT'] == True or cfg['HTTP_API_ENABLE'] == True or shm:
+    # the poller feeds MQTT as well as the LiveCache used by the HTTP API and the shared-memory table
+    poller = threading.Thread( target=MTEC_mqtt.poll_loop, args=(api, stop_event, cache, cfg['DAEMON_MQTT'] == True), 
+                               name="poller", daemon=True )
+    # topology changes are applied by the poller (also to the LiveCache) between two poll cycles
+    watcher.subscribe( lambda event: MTEC_mqtt.on_topology_change(api, event) )
+    poller.start()
+  httpserver = None
+  if cfg['HTTP_API_ENABLE'] == True:
+    httpserver = MTEC_http.http_start( api, cache, history )
+
+  try:
+    scheduler.run_forever( stop_event )
+  except KeyboardInterrupt:
+    stop_event.set()
+
+  if poller:
+    poller.join( timeout=cfg['PV_TIMEOUT']*2 )
+  if mqttclient:
+    MTEC_mqtt.mqtt_stop(mqttclient)
+  if httpserver:
+    MTEC_http.http_stop(httpserver)
+  if shm:
+    shm.close()
+  history.close()
+  logging.info("Stopped")
+
+#-------------------------------
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Local HTTP/JSON API for M-TEC Energybutler.
+Serves current station and device data from the poller's LiveCache and historical data
+from the local history store, so that local consumers don't need to query the portal themselves.
+(c) 2023 by Christian Rödel
+"""
+from config import cfg
+import logging
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from history import USAGE_PERIODS
+import analytics
+import datetime
+
+#-----------------------------
+class MTECrequestHandler( BaseHTTPRequestHandler ):
+  # set by http_start()
+  api = None
+  cache = None
+  history = None
+
+  ROUTES = [
+    ( re.compile(r"^/api/stations$"), "get_stations" ),
+    ( re.compile(r"^/api/stations/(?P<station_id>[^/]+)$"), "get_station" ),
+    ( re.compile(r"^/api/stations/(?P<station_id>[^/]+)/devices$"), "get_devices" ),
+    ( re.compile(r"^/api/devices/(?P<device_id>[^/]+)$"), "get_device" ),
+    ( re.compile(r"^/api/stations/(?P<station_id>[^/]+)/history/(?P<period>day|month|year|lifetime)$"), "get_history" ),
+    ( re.compile(r"^/api/stations/(?P<station_id>[^/]+)/analytics$"), "get_analytics" ),
+  ]
+
+  def log_message( self, format, *args ):
+    logging.debug( "HTTP {}: {}".format(self.address_string(), format % args) )
+
+  def send_json( self, status, data ):
+    body = json.dumps( data ).encode("utf-8")
+    self.send_response( status )
+    self.send_header( "Content-Type", "application/json; charset=utf-8" )
+    self.send_header( "Content-Length", str(len(body)) )
+    self.end_headers()
+    self.wfile.write( body )
+
+  def do_GET( self ):
+    url = urlsplit( self.path )
+    params = { k: v[0] for k, v in parse_qs(url.query).items() }
+    for pattern, handler in self.ROUTES:
+      m = pattern.match( url.path )
+      if m:
+        try:
+          status, data = getattr(self, handler)( params, **m.groupdict() )
+        except Exception as e:
+          logging.warning( "Error while handling HTTP request {}: {}".format(self.path, str(e)) )
+          status, data = 500, { "error": str(e) }
+        self.send_json( status, data )
+        return
+    self.send_json( 404, { "error": "Unknown path '{}'".format(url.path) } )
+
+  #-----------------------------
+  def get_stations( self, params ):
+    data = [ { "stationId": station_id, "name": station_data["name"] } for station_id, station_data in self.api.getStations() ]
+    return 200, data
+
+  def get_devices( self, params, station_id ):
+    data = [ dict(device_data, deviceId=device_id) for device_id, device_data in self.api.getDevices(station_id) ]
+    return 200, data
+
+  def _live( self, kind, id ):
+    entry = self.cache.get( kind, id )
+    if not entry:
+      return 404, { "error": "No data available for {} '{}'".format(kind, id) }
+    return 200, entry
+
+  def get_station( self, params, station_id ):
+    return self._live( "station", station_id )
+
+  def get_device( self, params, device_id ):
+    return self._live( "device", device_id )
+
+  def _bad_dates( self, params ):
+    # 400 response if ?start= or ?end= is given but no valid YYYY-MM-DD date (None if ok)
+    for name in ("start", "end"):
+      if name in params:
+        try:
+          datetime.date.fromisoformat( params[name] )
+        except ValueError:
+          return 400, { "error": "Invalid {} date '{}' (expected YYYY-MM-DD)".format(name, params[name]) }
+    return None
+
+  def get_history( self, params, station_id, period ):
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD (default: complete history)
+    if not self.history:
+      return 404, { "error": "History is not available" }
+    error = self._bad_dates( params )
+    if error:
+      return error
+    start = params.get( "start", "" )
+    end = params.get( "end", "9999" )
+    if period == "day":
+      return 200, self.history.get_day( station_id, start, end )
+    return 200, self.history.get_usage( station_id, USAGE_PERIODS[period], start, end )
+
+  def get_analytics( self, params, station_id ):
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD (default: current year)
+    if not self.history:
+      return 404, { "error": "History is not available" }
+    error = self._bad_dates( params )
+    if error:
+      return error
+    today = datetime.date.today()
+    start = params.get( "start", today.replace(month=1, day=1).isoformat() )
+    end = params.get( "end", today.isoformat() )
+    return 200, analytics.calculate_metrics( self.history, station_id, start, end )
+
+#-----------------------------
+def http_start( api, cache, history=None ):
+  MTECrequestHandler.api = api
+  MTECrequestHandler.cache = cache
+  MTECrequestHandler.history = history
+  try:
+    server = ThreadingHTTPServer( (cfg['HTTP_API_HOST'], cfg['HTTP_API_PORT']), MTECrequestHandler )
+  except OSError as e:
+    logging.warning("Couldn't start HTTP API: {}".format(str(e)))
+    return None
+  server.daemon_threads = True
+  threading.Thread( target=server.serve_forever, name="http-api", daemon=True ).start()
+  logging.info("HTTP API started on {}:{}".format(cfg['HTTP_API_HOST'], cfg['HTTP_API_PORT']))
+  return server
+
+def http_stop( server ):
+  server.shutdown()
+  server.server_close()
+  logging.info("HTTP API stopped")
@@ -3,16 +3,17 @@
 MQTT server for M-TEC Energybutler
 """
 
-from config import cfg
+from config import cfg, init_logging
 import MTECapi
+from units import normalize
 import logging
 import time
+import json
+import re
+import queue
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
-try:
-  import paho.mqtt.client as mqttcl
-  import paho.mqtt.publish as publish
-except Exception as e:
-  logging.warning("MQTT not set up because of: {}".format(e))
+# paho is imported on first use (in mqtt_start / mqtt_publish) to keep startup fast
 
 # ============ MQTT ================
 def on_mqtt_connect(mqttclient, userdata, flags, rc):
@@ -27,6 +28,7 @@ def on_mqtt_message(mqttclient, userdata, message):
 
 def mqtt_start(): 
   try: 
+    import paho.mqtt.client as mqttcl
     client = mqttcl.Client()
     client.username_pw_set(cfg['MQTT_LOGIN'], cfg['MQTT_PASSWORD']) 
     client.connect(cfg['MQTT_SERVER'], cfg['MQTT_PORT'], keepalive = 60) 
@@ -45,46 +47,25 @@ def mqtt_stop(client):
   except Exception as e:
     logging.warning("Couldn't stop MQTT: {}".format(str(e)))
 
-def mqtt_publish( topic, payload ):  
+def mqtt_publish( topic, payload, retain=False ):  
   auth = {
     'username': cfg['MQTT_LOGIN'],
     'password': cfg['MQTT_PASSWORD'] 
   }  
   logging.debug("Publish MQTT command {}: {}".format(topic, payload))
   try:
-    publish.single(topic, payload=payload, hostname=cfg['MQTT_SERVER'], port=cfg['MQTT_PORT'], auth=auth)
+    import paho.mqtt.publish as publish
+    publish.single(topic, payload=payload, retain=retain, hostname=cfg['MQTT_SERVER'], port=cfg['MQTT_PORT'], auth=auth)
   except Exception as e:
     logging.error("Could't send MQTT command: {}".format(str(e)))
 
 # =============================================
 
-def normalize( data ):
-  if( isinstance(data, dict) and "value" in data and "unit" in data ):
-    # Normalize power to W
-    if data["unit"] == "kW":
-      data["value"] *= 1000
-      data["unit"] = "W" 
-    elif data["unit"] == "MW":
-      data["value"] *= 1000000
-      data["unit"] = "W" 
-    elif data["unit"] == "GW":
-      data["value"] *= 1000000000          
-      data["unit"] = "W" 
-    # Normalize work to kWh
-    elif data["unit"] == "Wh":
-      data["value"] /= 1000
-      data["unit"] = "kWh" 
-    elif data["unit"] == "MWh":
-      data["value"] *= 1000
-      data["unit"] = "kWh" 
-    elif data["unit"] == "GWh":
-      data["value"] *= 1000000          
-      data["unit"] = "kWh" 
-  return data            
-
 # read station data from MTEC device
 def read_MTEC_station_data( api, station_id ):
   data = api.query_station_data(station_id)
+  if not data:
+    return None
   pvdata = {}
   pvdata["day_production"] = normalize(data["todayEnergy"])              # Energy produced by the PV today
   pvdata["month_production"] = normalize(data["monthEnergy"])            # Energy produced by the PV this month
@@ -108,6 +89,8 @@ def read_MTEC_station_data( api, station_id ):
 # read device data from MTEC device
 def read_MTEC_device_data( api, device_id ):
   data = api.query_device_data(device_id)
+  if not data:
+    return None
   pvdata = {}
   pvdata["battery_P"] = normalize(data["battery"]["Battery_P"])
   pvdata["battery_V"] = data["battery"]["Battery_V"]
@@ -127,9 +110,9 @@ def read_MTEC_device_data( api, device_id ):
   pvdata["grid_C_P"] = normalize(data["grid"]["PmeterPhaseC"])
 
   for string in data["PV"]:
-    pvdata["PV_"+string["name"]["value"]+"_P"] = normalize(string["power"]["value"])
-    pvdata["PV_"+string["name"]["value"]+"_V"] = string["voltage"]["value"]
-    pvdata["PV_"+string["name"]["value"]+"_I"] = string["current"]["value"]
+    pvdata["PV_"+string["name"]["value"]+"_P"] = normalize(string["power"])
+    pvdata["PV_"+string["name"]["value"]+"_V"] = string["voltage"]
+    pvdata["PV_"+string["name"]["value"]+"_I"] = string["current"]
 
   return pvdata
 
@@ -154,9 +137,273 @@ def write_to_MQTT( pvdata, base_topic ):
     logging.debug("- {}: {}".format(topic, str(payload)))
     mqtt_publish( topic, payload )
 
+# ============ Document mode ================
+# Instead of one topic per value, one document per station/device is published to <base_topic>state.
+# With MQTT_DELTA, only changed values are published to <base_topic>delta and the full document 
+# is refreshed every MQTT_FULL_EVERY cycles.
+_last_docs = {}         # base_topic -> last published full document
+_doc_cycles = {}        # base_topic -> cycles since last full document
+_discovery_sent = set() # base_topics for which Home Assistant discovery was published
+_msgpack_missing = False  # msgpack mode, but msgpack isn't installed: fall back to JSON
+
+def _payload_mode():
+  mode = cfg.get( 'MQTT_PAYLOAD_MODE', "topic" )
+  return "json" if mode == "msgpack" and _msgpack_missing else mode
+
+def _doc_value( data ):
+  if isinstance(data, dict):
+    data = data["value"]
+  if isinstance(data, bool):
+    return int(data)
+  if isinstance(data, float):
+    return round( data, cfg.get('MQTT_DOC_PRECISION', 2) )
+  return data
+
+def _encode_doc( doc ):
+  global _msgpack_missing
+  if _payload_mode() == "msgpack":
+    try:
+      import msgpack
+      return msgpack.packb( doc )
+    except ImportError:
+      logging.warning("msgpack not installed - falling back to JSON payload")
+      _msgpack_missing = True
+  return json.dumps( doc, separators=(',', ':') )
+
+# Home Assistant device classes by unit
+HASS_DEVICE_CLASSES = {
+  "W": ("power", "measurement"),
+  "kWh": ("energy", "total_increasing"),
+  "V": ("voltage", "measurement"),
+  "A": ("current", "measurement"),
+  "Hz": ("frequency", "measurement"),
+  "%": ("battery", "measurement"),
+}
+
+def publish_hass_discovery( pvdata, base_topic, name ):
+  # publish Home Assistant MQTT discovery config (once per station/device)
+  if base_topic in _discovery_sent:
+    return
+  device_id = re.sub( r"[^a-zA-Z0-9_]", "_", base_topic.strip("/") )
+  for param, data in pvdata.items():
+    config = {
+      "name": param,
+      "unique_id": device_id + "_" + param,
+      "state_topic": base_topic + "state",
+      "value_template": "{{{{ value_json.{} }}}}".format(param),
+      "availability_topic": base_topic + "availability",
+      "device": { "identifiers": [device_id], "name": name, "manufacturer": "M-TEC" },
+    }
+    unit = data.get("unit") if isinstance(data, dict) else None
+    if unit:
+      config["unit_of_measurement"] = unit
+      if unit in HASS_DEVICE_CLASSES:
+        config["device_class"], config["state_class"] = HASS_DEVICE_CLASSES[unit]
+    topic = "{}/sensor/{}_{}/config".format( cfg.get('HASS_BASE_TOPIC', "homeassistant"), device_id, param )
+    mqtt_publish( topic, json.dumps(config), retain=True )
+  _discovery_sent.add( base_topic )
+
+def write_to_MQTT_doc( pvdata, base_topic, name ):
+  doc = { param: _doc_value(data) for param, data in pvdata.items() }
+  if cfg.get('HASS_ENABLE') == True and _payload_mode() == "json":
+    publish_hass_discovery( pvdata, base_topic, name )
+
+  last = _last_docs.get( base_topic )
+  cycles = _doc_cycles.get( base_topic, 0 )
+  if cfg.get('MQTT_DELTA') == True and last is not None and cycles < cfg.get('MQTT_FULL_EVERY', 10):
+    delta = { param: value for param, value in doc.items() if last.get(param) != value }
+    _doc_cycles[base_topic] = cycles + 1
+    if delta:
+      logging.debug("- {}delta: {}".format(base_topic, str(delta)))
+      mqtt_publish( base_topic + "delta", _encode_doc(delta) )
+    last.update( delta )
+  else:
+    _last_docs[base_topic] = doc
+    _doc_cycles[base_topic] = 1
+    logging.debug("- {}state: {}".format(base_topic, str(doc)))
+    mqtt_publish( base_topic + "state", _encode_doc(doc), retain=True )
+
+# write data either as one topic per value or as document
+def write_data( pvdata, base_topic, name ):
+  if _payload_mode() == "topic":
+    write_to_MQTT( pvdata, base_topic )
+  else:
+    write_to_MQTT_doc( pvdata, base_topic, name )
+
+# ============ Polling ================
+# All stations and devices are queried in parallel (max. POLL_WORKERS at a time), each within its own job. 
+# A job which fails or doesn't finish within POLL_JOB_TIMEOUT after it actually started marks only its 
+# station/device as stale (and "offline"), without delaying the others.
+_executor = None
+_pending = {}         # (kind, id) -> future of the last query
+_started = {}         # (kind, id) -> start time (time.monotonic) of the last query
+_availability = {}    # base_topic -> "online" / "offline"
+
+def _job( key, func, *args ):
+  _started[key] = time.monotonic()
+  return func( *args )
+
+def _submit( kind, id, func, *args ):
+  key = (kind, str(id))
+  future = _pending.get( key )
+  if future and not future.done():
+    return None   # query of previous cycle still hangs - don't pile up further queries
+  _started.pop( key, None )
+  future = _executor.submit( _job, key, func, *args )
+  _pending[key] = future
+  return future
+
+def _wait_jobs( futures, timeout, max_wait ):
+  # futures: future -> (kind, id). Waits until each job is done or has run for timeout seconds.
+  # Jobs which couldn't even start (all workers busy) are given up after max_wait seconds.
+  # Returns the set of futures which are done in time.
+  done = set()
+  pending = dict( futures )
+  end = time.monotonic() + max_wait
+  while pending:
+    now = time.monotonic()
+    deadline = end
+    for future, key in list( pending.items() ):
+      start = _started.get( key )
+      if future.done():
+        done.add( future )
+      elif now < end and (start is None or now < start + timeout):
+        if start is not None:
+          deadline = min( deadline, start + timeout )
+        continue
+      del pending[future]
+    if pending:
+      # wake up on completion, when the next running job expires, or at least every second (for jobs started meanwhile)
+      wait( pending, timeout=max(0, min(deadline - now, 1)), return_when=FIRST_COMPLETED )
+  return done
+
+def publish_availability( base_topic, online ):
+  state = "online" if online else "offline"
+  if _availability.get( base_topic ) != state:
+    mqtt_publish( base_topic + "availability", state, retain=True )
+    _availability[base_topic] = state
+
+# ============ Poll plan ================
+# The stations/devices to poll and their topics are planned once. On topology changes (see 
+# topology.TopologyWatcher) only the affected entries are re-planned; all others keep their state.
+# Topology events are queued and applied by the poller thread between two cycles, so that the plan,
+# the MQTT state and the LiveCache (and its single-writer listeners) are only modified by this thread.
+_plan = {}    # (kind, id) -> (station_id, name, base_topic, write)
+_topology_events = queue.Queue()
+
+def _forget( base_topic ):
+  # drop the MQTT state of a removed/renamed station or device (and mark its old topic offline)
+  if _availability.get( base_topic ) == "online":
+    mqtt_publish( base_topic + "availability", "offline", retain=True )
+  _availability.pop( base_topic, None )
+  _last_docs.pop( base_topic, None )
+  _doc_cycles.pop( base_topic, None )
+  _discovery_sent.discard( base_topic )
+
+def _set_plan( kind, id, entry ):
+  old = _plan.get( (kind, id) )
+  if old and old[2] != entry[2]:
+    _forget( old[2] )
+  _plan[(kind, id)] = entry
+
+def _remove_plan( kind, id ):
+  old = _plan.pop( (kind, id), None )
+  if old:
+    _forget( old[2] )
+  _pending.pop( (kind, str(id)), None )
+  _started.pop( (kind, str(id)), None )
+
+def _plan_device( station_id, station_name, device_id, device_data ):
+  base_topic = cfg['MQTT_TOPIC'] + '/' + station_name + '/' + device_data['name'] + '/'
+  _set_plan( "device", device_id, (station_id, station_name + ' ' + device_data['name'], base_topic, cfg['WRITE_DEVICE_DATA'] == True) )
+
+def _plan_station( api, station_id, station_data ):
+  base_topic = cfg['MQTT_TOPIC'] + '/' + station_data['name'] + '/'
+  _set_plan( "station", station_id, (station_id, station_data['name'], base_topic, cfg['WRITE_STATION_DATA'] == True) )
+  for device_id, device_data in api.getDevices(station_id): 
+    _plan_device( station_id, station_data['name'], device_id, device_data )
+
+# topology.TopologyWatcher subscriber (called by the thread which refreshes the topology)
+def on_topology_change( api, event ):
+  _topology_events.put( event )
+
+def _apply_topology_change( api, event, cache=None ):
+  kind, id = event["kind"], event["id"]
+  if event["event"] == "remove":
+    _remove_plan( kind, id )
+    if cache:
+      cache.on_topology_change( event )
+  elif kind == "station":   # add or rename: topics of the station and all of its devices change
+    _plan_station( api, id, event["data"] )
+  elif event["station_id"] in api.topology:   # (station might have been removed by a later refresh)
+    _plan_device( event["station_id"], api.topology[event["station_id"]]["name"], id, event["data"] )
+
+# poll all stations and devices once and write their data to MQTT (if publish is set) and to the optional LiveCache
+def poll_cycle( api, cache=None, publish=True ):
+  global _executor
+  if _executor is None:
+    _executor = ThreadPoolExecutor( max_workers=cfg.get('POLL_WORKERS', 8), thread_name_prefix="poll" )
+  while not _topology_events.empty():
+    event = _topology_events.get()
+    if _plan:   # otherwise the plan is built from the current (already changed) topology below
+      _apply_topology_change( api, event, cache )
+  if not _plan:
+    for station_id, station_data in api.getStations():
+      _plan_station( api, station_id, station_data )
+
+  jobs = []   # (kind, id, name, base_topic, write, future)
+  for (kind, id), (station_id, name, base_topic, write) in list( _plan.items() ):
+    func = read_MTEC_station_data if kind == "station" else read_MTEC_device_data
+    jobs.append( (kind, id, name, base_topic, write, _submit(kind, id, func, api, id)) )
+
+  timeout = cfg.get('POLL_JOB_TIMEOUT', 2*cfg['PV_TIMEOUT'])
+  done = _wait_jobs( { job[-1]: (job[0], str(job[1])) for job in jobs if job[-1] }, timeout, max(timeout, cfg['POLL_FREQUENCY']) )
+
+  for kind, id, name, base_topic, write, future in jobs:
+    pvdata = None
+    if future is None:
+      error = "previous query still running"
+    elif future not in done:
+      error = "timeout" if future.running() or future.done() else "not started (all workers busy)"
+      future.cancel()   # only possible if not yet started; a running query ends with the request timeout
+    elif future.exception():
+      error = str( future.exception() )
+    else:
+      pvdata = future.result()
+      error = "no data"
+
+    if pvdata:
+      logging.debug("{} {} ({})".format( kind.capitalize(), name, id ))
+      if cache:
+        cache.update( kind, id, pvdata, name )
+      if publish and write:
+        write_data( pvdata, base_topic, name )
+        publish_availability( base_topic, True )
+    else:
+      logging.warning("Couldn't read data of {} {} ({}): {}".format( kind, name, id, error ))
+      if cache:
+        cache.mark_stale( kind, id )
+      if publish and write:
+        publish_availability( base_topic, False )
+
+# poll every POLL_FREQUENCY seconds until stop_event (a threading.Event) is set
+def poll_loop( api, stop_event=None, cache=None, publish=True ):
+  while not (stop_event and stop_event.is_set()):
+    start = time.monotonic()
+    try:
+      poll_cycle( api, cache, publish )
+    except Exception as e:
+      logging.error("Error during poll cycle: {}".format(str(e)))
+    wait_time = max( 0, cfg['POLL_FREQUENCY'] - (time.monotonic()-start) )
+    logging.debug("Sleep {:.1f}s".format( wait_time ))
+    if stop_event:
+      stop_event.wait(wait_time)
+    else:  
+      time.sleep(wait_time)
+
 #==========================================
 def main():
-  logging.basicConfig()
+  init_logging()
   if cfg['DEBUG'] == True:
     logging.getLogger().setLevel(logging.DEBUG)
   logging.info("Starting")
@@ -164,25 +411,11 @@ def main():
   # Inititialization
   mqttclient = mqtt_start()
   api = MTECapi.MTECapi()
-  stations = api.getStations()
-
-  while True:
-    for station_id, station_data in stations:
-      devices = api.getDevices(station_id)
-      pvdata = read_MTEC_station_data(api, station_id)
-      if cfg['WRITE_STATION_DATA'] == True:
-        logging.debug("Station {} ({})".format( station_data['name'], station_id ))
-        base_topic = cfg['MQTT_TOPIC'] + '/' + station_data['name'] + '/'
-        write_to_MQTT( pvdata, base_topic )
-      for device_id, device_data in devices: 
-        pvdata = read_MTEC_device_data(api, device_id)
-        if cfg['WRITE_DEVICE_DATA'] == True:
-          logging.debug("Device {} ({})".format( device_data['name'], device_id ))
-          base_topic = cfg['MQTT_TOPIC'] + '/' + station_data['name'] + '/' + device_data['name'] + '/'
-          write_to_MQTT( pvdata, base_topic )
-
-    logging.debug("Sleep {}s".format( cfg['POLL_FREQUENCY'] ))
-    time.sleep(cfg['POLL_FREQUENCY'])
+
+  try:
+    poll_loop( api )
+  except KeyboardInterrupt:
+    pass  
 
   mqtt_stop(mqttclient)
   logging.info("Stopped")
@@ -7,24 +7,25 @@ https://energybutler.mtec-portal.com
 """
 from config import cfg
 import logging
-import requests
 import hashlib
 import base64
 import json
 import time
+import threading
 from datetime import datetime
-from http.client import HTTPConnection
 
 #-------------------------------------------------
 class MTECapi:
     headers = None
     topology = {}
     retry = 0
+    login_lock = threading.RLock()  # API calls may be executed in parallel threads; only one of them re-logins
 
     #-------------------------------------------------
     def __init__( self ):
         self.email = cfg["PV_EMAIL"]
         self.password = cfg["PV_PASSWORD"]
+        self._lists = {}    # cached results of getStations() / getDevices()
         # Login
         self._login()
         # Query (and cache) topology info
@@ -96,9 +97,11 @@ class MTECapi:
 
     #---------------------------------------------
     def _do_API_call( self, url, params=None, payload=None, method="GET" ):
+        import requests     # imported on first use, as it is slow to load on low-end hardware
         result = {}
+        headers = self.headers
         try:
-            response = requests.request( method, cfg["PV_BASE_URL"]+url, headers=self.headers, params=params, 
+            response = requests.request( method, cfg["PV_BASE_URL"]+url, headers=headers, params=params, 
                                         json=payload, timeout=cfg["PV_TIMEOUT"] )
         except requests.exceptions.RequestException as err:
             logging.error( "Couldn't request REST API: {:s} {:s} ({:s}) Exception {:s}".format(url, method, str(payload), str(err)) )
@@ -107,19 +110,38 @@ class MTECapi:
             if response.status_code == 200:
                 result = response.json()
                 if result["code"] == "3010022":     # Login timeout - retry
-                    if self.retry < cfg["PV_MAX_LOGIN_RETRY"]:
-                        self.retry += 1
-                        logging.info( "Token expired - try re-login ({:n}/{:n})".format( self.retry, cfg["PV_MAX_LOGIN_RETRY"]) )
-                        if self._login():
-                            result = self._do_API_call( url, params, payload, method )
-                            if result["code"] == "1000000":
-                                self.retry = 0                 
-                    else:    
-                        logging.error( "Re-login failed. Giving up." )
+                    with self.login_lock:
+                        if self.headers is not headers:     # another thread did already re-login
+                            return self._do_API_call( url, params, payload, method )
+                        if self.retry < cfg["PV_MAX_LOGIN_RETRY"]:
+                            self.retry += 1
+                            logging.info( "Token expired - try re-login ({:n}/{:n})".format( self.retry, cfg["PV_MAX_LOGIN_RETRY"]) )
+                            if self._login():
+                                result = self._do_API_call( url, params, payload, method )
+                                if result["code"] == "1000000":
+                                    self.retry = 0                 
+                        else:    
+                            logging.error( "Re-login failed. Giving up." )
             else:
                 logging.error( "Couldn't request REST API: {:s} {:s} ({:s}) Response {}".format(url, method, str(payload), response) )
+                result["code"] = "-1"
         return result    
 
+    #---------------------------------------------
+    def _do_API_call_raw( self, url, params=None, payload=None, method="GET" ):
+        # like _do_API_call, but returns the undecoded response body (or None) without any login retry
+        import requests
+        try:
+            response = requests.request( method, cfg["PV_BASE_URL"]+url, headers=self.headers, params=params, 
+                                        json=payload, timeout=cfg["PV_TIMEOUT"] )
+        except requests.exceptions.RequestException as err:
+            logging.error( "Couldn't request REST API: {:s} {:s} ({:s}) Exception {:s}".format(url, method, str(payload), str(err)) )
+            return None
+        if response.status_code != 200:
+            logging.error( "Couldn't request REST API: {:s} {:s} ({:s}) Response {}".format(url, method, str(payload), response) )
+            return None
+        return response.content
+
     #-------------------------------------------------
     def query_base_info( self ):
         url = "basePowerStationInfo/getRunningOverview"
@@ -140,7 +162,10 @@ class MTECapi:
             logging.error( "Error while retrieving base info: {}".format( str(json_data) ) )
 
     #-------------------------------------------------
-    def query_device_list( self, stationId ):
+    def query_device_list( self, stationId, topology=None ):
+        # fills the device list of the station in topology (default: cached topology)
+        if topology is None:
+            topology = self.topology
         url = "managerv2/station/devices/query"
         params = {
             "stationId": stationId      
@@ -149,7 +174,7 @@ class MTECapi:
         if json_data["code"] == "1000000":
             # cache devices
             for list in json_data["data"]:
-                self.topology[stationId]["devices"][list["deviceId"]] = {
+                topology[stationId]["devices"][list["deviceId"]] = {
                     "name": list["deviceName"],
                     "deviceSn": list["deviceSn"],
                     "deviceType": list["deviceType"],
@@ -160,6 +185,29 @@ class MTECapi:
             logging.error( "Error while retrieving device list for stationId '{}': {}".format( stationId, str(json_data) ) )
             return False
 
+    #-------------------------------------------------
+    def fetch_topology( self ):
+        # Re-read stations and devices from the portal (without touching the cached topology).
+        # Returns None if the topology couldn't be read completely
+        base_info = self.query_base_info()
+        if not base_info:
+            return None
+        topology = {}
+        for list in base_info["top10List"]:
+            topology[list["stationId"]] = { 
+                "name": list["stationName"],
+                "devices": {} 
+            }
+            if not self.query_device_list( list["stationId"], topology ):
+                return None
+        return topology
+
+    #-------------------------------------------------
+    def set_topology( self, topology ):
+        # replace (not modify) the cached topology, so that other threads can keep iterating the old one
+        self.topology = topology
+        self._lists = {}
+
     #-------------------------------------------------
     def lookup_direction( self, direction ):
         if direction == 1:
@@ -236,22 +284,42 @@ class MTECapi:
             return self._query_usage_data( stationId, durationType, dateTime )
 
     #-------------------------------------------------
-    def _query_usage_data_day( self, stationId, durationType, dateTime=None ): 
-        url = "curve/station/queryStationCurve"
+    def _usage_request( self, stationId, durationType, dateTime=None ):
+        # returns url, payload and date_str of a usage data query
         date_str = ""
         if dateTime == None:
             dateTime = datetime.now()
 
-        dt = 1
-        date_str = dateTime.strftime("%Y-%m-%d")
+        if durationType=="day" or durationType=="daysummary":
+            url = "curve/station/queryStationCurve"
+            dt = 1
+            date_str = dateTime.strftime("%Y-%m-%d")
+            type = "powerflow"
+        else:
+            url = "curve/station/queryStationBarChart"
+            type = "update"
+            if durationType=="month":
+                dt = 2
+                date_str = dateTime.strftime("%Y-%m")
+            elif durationType=="year":
+                dt = 3
+                date_str = dateTime.strftime("%Y")
+            elif durationType=="lifetime":
+                dt = 4
+                        
         payload = {
             "stationId": stationId,
             "durationType": dt,
             "date": date_str,
             "stationType": 0,
             "timeZoneOffset": self._getTimezoneOffset(),
-            "type": "powerflow"
+            "type": type
         }
+        return url, payload, date_str
+
+    #-------------------------------------------------
+    def _query_usage_data_day( self, stationId, durationType, dateTime=None ): 
+        url, payload, date_str = self._usage_request( stationId, durationType, dateTime )
         json_data = self._do_API_call( url, payload=payload, method="POST" )
         if json_data["code"] == "1000000":
             if durationType=="day":
@@ -264,28 +332,7 @@ class MTECapi:
 
     #-------------------------------------------------
     def _query_usage_data( self, stationId, durationType, dateTime=None ): 
-        url = "curve/station/queryStationBarChart"
-        date_str = ""
-        if dateTime == None:
-            dateTime = datetime.now()
-
-        if durationType=="month":
-            dt = 2
-            date_str = dateTime.strftime("%Y-%m")
-        elif durationType=="year":
-            dt = 3
-            date_str = dateTime.strftime("%Y")
-        elif durationType=="lifetime":
-            dt = 4
-                        
-        payload = {
-            "stationId": stationId,
-            "durationType": dt,
-            "date": date_str,
-            "stationType": 0,
-            "timeZoneOffset": self._getTimezoneOffset(),
-            "type": "update"
-        }
+        url, payload, date_str = self._usage_request( stationId, durationType, dateTime )
         json_data = self._do_API_call( url, payload=payload, method="POST" )
         if json_data["code"] == "1000000":
             return self._parse_usage_data( date_str, json_data )
@@ -294,7 +341,30 @@ class MTECapi:
             return False
 
     #-------------------------------------------------
-    def _parse_usage_data_day_summary( self, json_data ):            
+    def query_usage_data_raw( self, stationId, durationType, dateTime=None ): 
+        # returns (date_str, undecoded response body) - to be parsed by parse_usage_data(), e.g. in another process
+        url, payload, date_str = self._usage_request( stationId, durationType, dateTime )
+        return date_str, self._do_API_call_raw( url, payload=payload, method="POST" )
+
+    #-------------------------------------------------
+    @staticmethod
+    def parse_usage_data( durationType, date_str, raw ):
+        # parse a raw response of query_usage_data_raw(); returns False if the response contains an error
+        # (e.g. expired login, which has to be handled by a regular query_usage_data() call)
+        if not raw:
+            return False
+        json_data = json.loads( raw )
+        if json_data.get("code") != "1000000":
+            return False
+        if durationType=="day":
+            return MTECapi._parse_usage_data_day( json_data )
+        elif durationType=="daysummary":
+            return MTECapi._parse_usage_data_day_summary( json_data )
+        return MTECapi._parse_usage_data( date_str, json_data )
+
+    #-------------------------------------------------
+    @staticmethod
+    def _parse_usage_data_day_summary( json_data ):            
         # map data into data structure (daily summary)
         data = {}
         d = json_data["data"]["eRatioGraph"]
@@ -306,7 +376,8 @@ class MTECapi:
         return data
 
     #-------------------------------------------------
-    def _parse_usage_data_day( self, json_data ):            
+    @staticmethod
+    def _parse_usage_data_day( json_data ):            
         # map data into data structure (daily is different from the other time ranges)
         data = []
         d = json_data["data"]["curve"]
@@ -317,15 +388,18 @@ class MTECapi:
             PV = i.get("power") 
             battery = i.get("battery") 
             SOC = i.get("SOC")
-            if ts and load and grid and PV and battery and SOC:
+            # keep legitimate zero values - only drop points which are actually missing
+            if ts and None not in (load, grid, PV, battery, SOC):
                 data.append( { "ts": ts, "load": load, "grid": grid, "PV": PV, "battery": battery, "SOC": SOC } )
         return data
 
     #-------------------------------------------------
-    def _parse_usage_data( self, date_str, json_data ):            
+    @staticmethod
+    def _parse_usage_data( date_str, json_data ):            
         # map data into data structure
         d = json_data["data"]["curve"]
         data = []
+        today = datetime.now().strftime("%Y-%m-%d")
         for i in d:
             if date_str: # month or year
                 date = date_str + "-" + i.get("date") 
@@ -338,7 +412,8 @@ class MTECapi:
             pv_production = i.get("eTotal")    
             load = i.get("eusetotal") 
 
-            if date and pv_production:
+            # keep days without PV production - only skip missing values and (zero) rows of future dates
+            if date and pv_production is not None and date <= today[:len(date)]:
                 data.append( { "date": date, "load": load, "pv_production": pv_production,
                     "grid_load": grid_load, "grid_feed": grid_feed, "battery_load": battery_load, "battery_feed": battery_feed } )
         return data
@@ -409,21 +484,29 @@ class MTECapi:
             return False
 
     #-------------------------------------------------
+    # The lists are cached until the topology changes (see set_topology) - don't modify them
     def getStations( self ):
-        stations = []
-        for station_id, station_data in self.topology.items():
-            item = [station_id, station_data]   
-            stations.append(item)
+        stations = self._lists.get( "stations" )
+        if stations is None:
+            stations = []
+            for station_id, station_data in self.topology.items():
+                item = [station_id, station_data]   
+                stations.append(item)
+            self._lists["stations"] = stations
         return stations
 
     #-------------------------------------------------
     def getDevices( self, station_id ):
+        devices = self._lists.get( ("devices", str(station_id)) )
+        if devices is not None:
+            return devices
         devices = []
         try:
             device_list = self.topology[str(station_id)]["devices"]
             for device_id, device_data in device_list.items():
                 item = [device_id, device_data]
                 devices.append(item)
+            self._lists[("devices", str(station_id))] = devices
         except:
             logging.error( "Couldn't get devices for station '{}'".format( station_id ) )
         return devices
@@ -433,6 +516,8 @@ if __name__ == "__main__":
     logging.basicConfig( level=logging.DEBUG, format="%(asctime)s : %(levelname)s : %(message)s" )
 
 # uncomment following lines to debug https calls
+#    import requests
+#    from http.client import HTTPConnection
 #    HTTPConnection.debuglevel = 1
 #    requests_log = logging.getLogger("urllib3")
 #    requests_log.setLevel(logging.DEBUG)
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Derived metrics (self-consumption, autarky, battery cycles, peak load, cost) calculated
+from the local history store - without querying the M-TEC portal.
+(c) 2023 by Christian Rödel
+"""
+from config import cfg, BASE_DIR, init_logging
+from history import MTEChistory
+import argparse
+import datetime
+import os
+
+ENERGY_FIELDS = [ "pv_production", "load", "grid_load", "grid_feed", "battery_load", "battery_feed" ]
+
+#-----------------------------
+def _ratio( numerator, denominator ):
+  if numerator is None or not denominator:
+    return None
+  return numerator / denominator
+
+#-----------------------------
+def calculate_metrics( history, stationId, start, end ):
+  # metrics for start <= date <= end (dates as "YYYY-MM-DD")
+  rows = history.get_aggregates( stationId, start, end )
+  result = { "stationId": str(stationId), "start": start, "end": end, "days": sum( row["days"] or 0 for row in rows ) }
+  for field in ENERGY_FIELDS:
+    values = [ row[field] for row in rows if row[field] is not None ]
+    result[field] = sum(values) if values else None   # kWh
+
+  peak = max( (row for row in rows if row["peak_load"] is not None), key=lambda row: row["peak_load"], default=None )
+  result["peak_load"] = peak["peak_load"] if peak else None    # W
+  result["peak_load_ts"] = peak["peak_load_ts"] if peak else None
+
+  # ratios only cover days with daily usage data (grid values are missing for days with curves only)
+  pv = sum( row["usage_pv_production"] for row in rows if row["usage_pv_production"] is not None )
+  load = sum( row["usage_load"] for row in rows if row["usage_load"] is not None )
+  # share of the PV production which was used locally (not fed into the grid)
+  result["self_consumption"] = _ratio( pv - result["grid_feed"], pv ) if result["grid_feed"] is not None else None
+  # share of the consumption which was not bought from the grid
+  result["autarky"] = _ratio( load - result["grid_load"], load ) if result["grid_load"] is not None else None
+  # full equivalent battery cycles: half of (charged + discharged energy) per capacity
+  if cfg.get('BATTERY_CAPACITY') and result["battery_load"] is not None and result["battery_feed"] is not None:
+    result["battery_cycles"] = (result["battery_load"] + result["battery_feed"]) / 2 / cfg['BATTERY_CAPACITY']
+  else:
+    result["battery_cycles"] = None
+  result["grid_cost"] = result["grid_load"] * cfg['GRID_PRICE'] if cfg.get('GRID_PRICE') is not None and result["grid_load"] is not None else None
+  result["feed_in_revenue"] = result["grid_feed"] * cfg['FEED_IN_TARIFF'] if cfg.get('FEED_IN_TARIFF') is not None and result["grid_feed"] is not None else None
+  return result
+
+#-----------------------------
+def _fmt( value, format="{:.2f}" ):
+  return "-" if value is None else format.format(value)
+
+def print_report( m ):
+  print( "--------------------------------------------------------" )
+  print( "Station '{}': {} - {} ({} days with data)".format( m["stationId"], m["start"], m["end"], m["days"] ))
+  print( "- PV production:     {} kWh".format( _fmt(m["pv_production"]) ))
+  print( "- Consumption:       {} kWh".format( _fmt(m["load"]) ))
+  print( "- Grid import:       {} kWh".format( _fmt(m["grid_load"]) ))
+  print( "- Grid feed-in:      {} kWh".format( _fmt(m["grid_feed"]) ))
+  print( "- Battery charge:    {} kWh".format( _fmt(m["battery_feed"]) ))
+  print( "- Battery discharge: {} kWh".format( _fmt(m["battery_load"]) ))
+  print( "- Self-consumption:  {} %".format( _fmt(m["self_consumption"] and m["self_consumption"]*100, "{:.1f}") ))
+  print( "- Autarky:           {} %".format( _fmt(m["autarky"] and m["autarky"]*100, "{:.1f}") ))
+  print( "- Battery cycles:    {}".format( _fmt(m["battery_cycles"], "{:.1f}") ))
+  print( "- Peak load:         {} W ({})".format( _fmt(m["peak_load"], "{:.0f}"), m["peak_load_ts"] or "-" ))
+  print( "- Grid cost:         {}".format( _fmt(m["grid_cost"]) ))
+  print( "- Feed-in revenue:   {}".format( _fmt(m["feed_in_revenue"]) ))
+
+#-----------------------------
+def parse_options():
+  today = datetime.date.today()
+  parser = argparse.ArgumentParser(description='MTEC analytics. Calculates derived metrics from the local history store')
+  parser.add_argument( '-s', '--startdate', default=today.replace(month=1, day=1).isoformat(), help='start date [YYYY-MM-DD] (default is 1st of January)' )
+  parser.add_argument( '-e', '--enddate', default=today.isoformat(), help='end date [YYYY-MM-DD] (default is "today")' )
+  parser.add_argument( '-i', '--stationid', help='stationId (default: all stations in the history store)')
+  return parser.parse_args()
+
+#-------------------------------
+def main():
+  args = parse_options()
+  init_logging()
+  history = MTEChistory( os.path.join(BASE_DIR, cfg['HISTORY_DB']) )
+  station_ids = [ args.stationid ] if args.stationid else history.get_station_ids()
+  for stationId in station_ids:
+    print_report( calculate_metrics(history, stationId, args.startdate, args.enddate) )
+  history.close()
+
+#-------------------------------
+if __name__ == '__main__':
+  main()
@@ -1,22 +1,60 @@
 """ Read YAML config files
+The parsed config is cached (marshal) in __pycache__, so that YAML has only to be imported
+and parsed if config.yaml has changed.
 """
-import yaml
 import os
 import logging
-import types 
+import marshal
 
 #----------------------------------------
-logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
-BASE_DIR = os.path.dirname(__file__) # Base installation directory
+BASE_DIR = os.path.dirname(os.path.abspath(__file__)) # Base installation directory
+CACHE_FILE = os.path.join(BASE_DIR, "__pycache__", "config.yaml.marshal")
 
-try:
+#----------------------------------------
+def init_logging():
+  # to be called by the main() of the command line tools (not at import time)
+  logging.basicConfig( level=logging.INFO, format="[%(levelname)s] %(filename)s: %(message)s" )
+
+#----------------------------------------
+def _read_cache( stamp ):
+  try:
+    with open(CACHE_FILE, 'rb') as f:
+      cached_stamp, data = marshal.load(f)
+    if cached_stamp == stamp:
+      return data
+  except (OSError, EOFError, ValueError, TypeError):
+    pass
+  return None
+
+def _write_cache( stamp, data ):
+  try:
+    os.makedirs(os.path.dirname(CACHE_FILE), exist_ok=True)
+    tmp_file = CACHE_FILE + ".{}.tmp".format(os.getpid())
+    with open(tmp_file, 'wb') as f:
+      marshal.dump( (stamp, data), f )
+    os.replace( tmp_file, CACHE_FILE )
+  except (OSError, ValueError):  # e.g. read-only installation or types marshal can't handle
+    pass
+
+def load_config():
   fname = os.path.join(BASE_DIR, "config.yaml")
-  with open(fname, 'r', encoding='utf-8') as myfile:
-    cfg = yaml.safe_load(myfile)
-except yaml.YAMLError as err:
-  logging.error("Couldn't read config file {}: {}".format(fname, str(err)) )
+  st = os.stat(fname)
+  stamp = (st.st_mtime_ns, st.st_size)
+  data = _read_cache( stamp )
+  if data is None:
+    import yaml
+    try:
+      with open(fname, 'r', encoding='utf-8') as myfile:
+        data = yaml.safe_load(myfile)
+    except yaml.YAMLError as err:
+      logging.error("Couldn't read config file {}: {}".format(fname, str(err)) )
+      return None
+    _write_cache( stamp, data )
+  return data
+
+cfg = load_config()
 
 #--------------------------------------
 if __name__ == "__main__":
+  init_logging()
   logging.info( "Config: {}".format( str(cfg)) )
-  
\ No newline at end of file
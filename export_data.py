@@ -3,38 +3,121 @@
 This is a command line tool which enables to export data from a MTEC device as CSV. 
 (c) 2023 by Christian Rödel 
 """
-from config import cfg
+from config import cfg, init_logging
 import datetime
-from dateutil.relativedelta import relativedelta
 import argparse
 import sys
+import os
 import MTECapi
+import units
+
+DAY_HEADER = "timestamp;load;grid;PV;battery;SOC"
+USAGE_HEADER = "date;load;pv_production;battery_load;battery_feed;grid_load;grid_feed"
+
+#-----------------------------
+def format_usage_data_day( data, separator ):
+  # CSV lines (incl. line breaks) of day curve items
+  text = "".join( [ "{};{};{};{};{};{}\n".format( item["ts"], item["load"], item["grid"], 
+                                                item["PV"], item["battery"], item["SOC"] ) for item in data ] )
+  return text.replace(".", separator) if separator != "." else text
+
+#-----------------------------
+def format_usage_data( data, separator ):
+  # CSV lines (incl. line breaks) of bar chart items
+  text = "".join( [ "{};{};{};{};{};{};{}\n".format( item["date"], item["load"], item["pv_production"],
+                      item["battery_load"], item["battery_feed"], item["grid_load"], item["grid_feed"] ) for item in data ] )
+  return text.replace(".", separator) if separator != "." else text
 
 #-----------------------------
-def process_usage_data_day( api, stationId, start_date, end_date, separator ):
-  print( "timestamp;load;grid;PV;battery;SOC")
+def usage_dates( durationType, start_date, end_date ):
+  # dates to query for an export from start_date to end_date
+  from dateutil.relativedelta import relativedelta
+  step = datetime.timedelta(days=1) if durationType == "day" else relativedelta(months=1)
+  dates = []
   date = start_date
   while date < end_date:
+    dates.append( date )
+    date += step
+  return dates
+
+#-----------------------------
+def process_usage_data_day( api, stationId, start_date, end_date, separator, out=None, history=None, normalized=False ):
+  print( DAY_HEADER, file=out )
+  for date in usage_dates( "day", start_date, end_date ):
     data = api.query_usage_data( stationId, "day", date )
+    if history and data is not False:   # also record empty days in the coverage
+      history.store_day( stationId, date, data )
     if data: 
-      for item in data:
-        line = "{};{};{};{};{};{}".format( item["ts"], item["load"], item["grid"], 
-                                             item["PV"], item["battery"], item["SOC"] )
-        print( line.replace(".", separator) )
-    date += datetime.timedelta(days=1)
+      if normalized:
+        data = units.normalize_rows( data, units.DAY_CURVE_UNITS )
+      print( format_usage_data_day( data, separator ), end="", file=out )
 
 #-----------------------------
-def process_usage_data( api, stationId, durationType, start_date, end_date, separator ):
-  print( "date;load;pv_production;battery_load;battery_feed;grid_load;grid_feed")
-  date = start_date
-  while date < end_date:
+def process_usage_data( api, stationId, durationType, start_date, end_date, separator, out=None, history=None ):
+  print( USAGE_HEADER, file=out )
+  for date in usage_dates( durationType, start_date, end_date ):
     data = api.query_usage_data( stationId, durationType, date )
     if data: 
-      for item in data:
-        line = "{};{};{};{};{};{};{}".format( item["date"], item["load"], item["pv_production"],
-                            item["battery_load"], item["battery_feed"], item["grid_load"], item["grid_feed"] )
-        print( line.replace(".", separator) )
-    date += relativedelta(months=1)
+      if history:
+        history.store_usage( stationId, durationType, data )
+      print( format_usage_data( data, separator ), end="", file=out )
+
+#-----------------------------
+def _format( durationType, data, separator, normalized ):
+  if durationType == "day":
+    return format_usage_data_day( units.normalize_rows(data, units.DAY_CURVE_UNITS) if normalized else data, separator )
+  return format_usage_data( data, separator )   # bar chart data is in kWh already
+
+def _parse_and_format( durationType, date_str, raw, separator, normalized, with_data ):
+  # CPU bound part of the export - executed in a worker process
+  data = MTECapi.MTECapi.parse_usage_data( durationType, date_str, raw )
+  if data is False:
+    return False, None
+  return (data if with_data else None), _format( durationType, data, separator, normalized )
+
+#-----------------------------
+def process_usage_data_parallel( api, jobs, separator, out=None, history=None, normalized=False, workers=4 ):
+  # Backfill pipeline: jobs (list of (stationId, durationType, date)) are fetched by <workers> threads,
+  # raw responses are parsed and formatted by a process pool, and results are written in the order of jobs.
+  from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+  from collections import deque
+  import multiprocessing
+  # Don't fork worker processes from a process with running threads (I/O pool, daemon threads):
+  # they would inherit locks held by other threads. Use a fork server (or spawn where unavailable).
+  method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+  jobs = iter( jobs )
+  fetches = deque()
+  parses = deque()
+  window = 4 * workers    # max. no. of fetched but not yet written responses
+  with ThreadPoolExecutor( max_workers=workers ) as io_pool, ProcessPoolExecutor( mp_context=multiprocessing.get_context(method) ) as cpu_pool:
+    def fill():
+      while len(fetches) + len(parses) < window:
+        job = next( jobs, None )
+        if job is None:
+          break
+        fetches.append( (job, io_pool.submit(api.query_usage_data_raw, *job)) )
+
+    fill()
+    while fetches or parses:
+      # hand over fetched responses to the process pool (in order), without waiting if parsed results are pending
+      while fetches and (fetches[0][1].done() or not parses):
+        job, future = fetches.popleft()
+        date_str, raw = future.result()
+        parses.append( (job, cpu_pool.submit(_parse_and_format, job[1], date_str, raw, separator, normalized, history is not None)) )
+        fill()
+      (stationId, durationType, date), future = parses.popleft()
+      data, text = future.result()
+      if data is False:   # error or expired login: retry by regular (sequential) query
+        data = api.query_usage_data( stationId, durationType, date )
+        text = _format( durationType, data, separator, normalized ) if data else None
+      if history and data is not False and data is not None:
+        if durationType == "day":
+          history.store_day( stationId, date, data )
+        elif data:
+          history.store_usage( stationId, durationType, data )
+      if text:
+        print( text, end="", file=out )
+      fill()
 
 #-----------------------------
 def parse_options():
@@ -46,11 +129,15 @@ def parse_options():
   parser.add_argument( '-n', '--name', help='Your MTEC station name (only required if you have multiple stations)')
   parser.add_argument( '-d', '--separator', help='Set decimal separator (default is ".")' )
   parser.add_argument( '-f', '--file', help='Write data to <FILE> instead of stdout')
+  parser.add_argument( '-u', '--normalize', action='store_true', help='Normalize units of "day" export (power in W instead of kW)')
+  parser.add_argument( '-w', '--workers', type=int, default=0, help='Fetch data with <WORKERS> parallel connections and parse it on all CPU cores (for large exports)')
+  parser.add_argument( '-H', '--history', action='store_true', help='Additionally store data in the local history store (HISTORY_DB)')
   return parser.parse_args()
  
 #-------------------------------
 def main():
   args = parse_options()
+  init_logging()
   api = MTECapi.MTECapi()       # Create MTECapi connection
   stations = api.getStations()   # retrieve available stations
 
@@ -96,11 +183,25 @@ def main():
   else:
     separator = "."  
       
+  # local history store (if defined as command line parameter)
+  history = None
+  if args.history:
+    from config import BASE_DIR
+    from history import MTEChistory
+    history = MTEChistory( os.path.join(BASE_DIR, cfg['HISTORY_DB']) )
+
   # do the actual export
-  if args.type == "day": 
-    process_usage_data_day( api, stationId, start_date, end_date, separator )
+  if args.workers > 0:
+    print( DAY_HEADER if args.type == "day" else USAGE_HEADER )
+    jobs = [ (stationId, args.type, date) for date in usage_dates(args.type, start_date, end_date) ]
+    process_usage_data_parallel( api, jobs, separator, history=history, normalized=args.normalize, workers=args.workers )
+  elif args.type == "day": 
+    process_usage_data_day( api, stationId, start_date, end_date, separator, history=history, normalized=args.normalize )
   else: 
-    process_usage_data( api, stationId, args.type, start_date, end_date, separator )
+    process_usage_data( api, stationId, args.type, start_date, end_date, separator, history=history )
+
+  if history:
+    history.close()
 
   # cleanup
   if args.file:
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Gap detection for the local history store.
+Reports the coverage of the 5 min day curves and re-fetches only incomplete days
+(and months with missing daily usage data) from the M-TEC portal.
+(c) 2023 by Christian Rödel
+"""
+from config import cfg, BASE_DIR, init_logging
+from history import MTEChistory
+import MTECapi
+import argparse
+import datetime
+import logging
+import os
+
+#-----------------------------
+def find_gaps( history, stationId, start, end ):
+  # incomplete days and days with missing usage rows (both only if fetched less than COVERAGE_MAX_FETCHES times)
+  max_fetches = cfg.get( 'COVERAGE_MAX_FETCHES', 3 )
+  days = [ item["date"] for item in history.get_coverage( stationId, start, end )
+           if not item["complete"] and item["fetches"] < max_fetches ]
+  usage_days = history.get_missing_usage_dates( stationId, start, end, max_fetches )
+  return days, usage_days
+
+#-----------------------------
+def refetch_gaps( api, history, stationId, start, end ):
+  # fetch incomplete data for start <= date <= end; returns no. of API calls
+  days, usage_days = find_gaps( history, stationId, start, end )
+  months = sorted( set( date[:7] for date in usage_days ) )
+  for month in months:
+    data = api.query_usage_data( stationId, "month", datetime.datetime.strptime(month, "%Y-%m") )
+    if data:
+      history.store_usage( stationId, "month", data )
+    history.record_usage_fetch( stationId, [ date for date in usage_days if date.startswith(month) ] )
+  for day in days:
+    data = api.query_usage_data( stationId, "day", datetime.datetime.strptime(day, "%Y-%m-%d") )
+    if data is not False:
+      history.store_day( stationId, datetime.datetime.strptime(day, "%Y-%m-%d"), data, count_fetch=True )
+  logging.info( "Station {}: re-fetched {} incomplete days and {} months ({} - {})".format(stationId, len(days), len(months), start, end) )
+  return len(days) + len(months)
+
+#-----------------------------
+def default_range( days=None ):
+  # last COVERAGE_DAYS days until yesterday (today is still incomplete)
+  if days is None:
+    days = cfg.get( 'COVERAGE_DAYS', 60 )
+  yesterday = datetime.date.today() - datetime.timedelta(days=1)
+  return (yesterday - datetime.timedelta(days=days-1)).isoformat(), yesterday.isoformat()
+
+#-----------------------------
+def print_coverage( history, stationId, start, end ):
+  coverage = history.get_coverage( stationId, start, end )
+  print( "--------------------------------------------------------" )
+  print( "Station '{}': {} - {}".format(stationId, start, end) )
+  months = {}
+  for item in coverage:
+    m = months.setdefault( item["date"][:7], [0, 0, []] )
+    m[0] += item["received"]
+    m[1] += item["expected"]
+    if not item["complete"]:
+      m[2].append( "{} ({}/{}, re-fetched {}x)".format(item["date"][8:], item["received"], item["expected"], item["fetches"]) )
+  for month, (received, expected, incomplete) in months.items():
+    print( "- {}: {:5.1f}% of 5 min values".format(month, received/expected*100) )
+    for day in incomplete:
+      print( "    incomplete: {}".format(day) )
+  missing = history.get_missing_usage_months( stationId, start, end )
+  if missing:
+    print( "Months with missing daily usage data: {}".format(", ".join(missing)) )
+
+#-----------------------------
+def parse_options():
+  start, end = default_range()
+  parser = argparse.ArgumentParser(description='MTEC gap detection. Reports and re-fetches incomplete data of the local history store')
+  parser.add_argument( '-s', '--startdate', default=start, help='start date [YYYY-MM-DD] (default: COVERAGE_DAYS days ago)' )
+  parser.add_argument( '-e', '--enddate', default=end, help='end date [YYYY-MM-DD] (default is "yesterday")' )
+  parser.add_argument( '-i', '--stationid', help='stationId (default: all stations)')
+  parser.add_argument( '-r', '--refetch', action='store_true', help='Re-fetch incomplete days from M-TEC portal')
+  return parser.parse_args()
+
+#-------------------------------
+def main():
+  args = parse_options()
+  init_logging()
+  history = MTEChistory( os.path.join(BASE_DIR, cfg['HISTORY_DB']) )
+  api = None
+  if args.refetch:
+    api = MTECapi.MTECapi()
+    station_ids = [ station_id for station_id, _ in api.getStations() ]
+  else:
+    station_ids = history.get_station_ids()
+  if args.stationid:
+    station_ids = [ args.stationid ]
+
+  for stationId in station_ids:
+    if api:
+      refetch_gaps( api, history, stationId, args.startdate, args.enddate )
+    print_coverage( history, stationId, args.startdate, args.enddate )
+  history.close()
+
+#-------------------------------
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""
+Local history store for usage data (SQLite).
+Keeps day curves (5 min resolution) and bar chart rows (day/month/year resolution) per station.
+Values are stored normalized: power in W (day curves are converted), energy in kWh.
+(c) 2023 by Christian Rödel
+"""
+import sqlite3
+import threading
+import datetime
+import re
+import units
+
+USAGE_FIELDS = [ "load", "pv_production", "grid_load", "grid_feed", "battery_load", "battery_feed" ]
+CURVE_FIELDS = [ "load", "grid", "PV", "battery", "SOC" ]
+
+# durationType of the query -> period (resolution) of the returned rows
+USAGE_PERIODS = { "month": "day", "year": "month", "lifetime": "year" }
+
+# day curves have a resolution of 5 min
+SLOTS_PER_DAY = 288
+_TIME_RE = re.compile( r"(\d{1,2}):(\d{2})" )
+
+# columns of the cached day and month aggregates (energy in kWh, power in W).
+# usage_pv_production / usage_load only cover days with a daily bar chart row, i.e. the same days as the
+# grid and battery values (which can't be derived from the curves), so that ratios don't mix different days.
+AGGREGATE_FIELDS = [ "pv_production", "load", "grid_load", "grid_feed", "battery_load", "battery_feed", "peak_load", "peak_load_ts", "days",
+                     "usage_pv_production", "usage_load" ]
+# bump if the aggregate tables change - they are only caches and get rebuilt
+AGGREGATE_VERSION = 3
+
+#-------------------------------------------------
+class MTEChistory:
+    #-------------------------------------------------
+    def __init__( self, fname ):
+        self.fname = fname
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect( fname, check_same_thread=False )
+        self.db.row_factory = sqlite3.Row
+        self._create_tables()
+
+    #-------------------------------------------------
+    def _create_tables( self ):
+        with self._lock, self.db:
+            self.db.execute( """CREATE TABLE IF NOT EXISTS day_curve (
+                station_id TEXT, date TEXT, ts TEXT, 
+                load REAL, grid REAL, PV REAL, battery REAL, SOC REAL,
+                PRIMARY KEY (station_id, date, ts) )""" )
+            self.db.execute( """CREATE TABLE IF NOT EXISTS usage (
+                station_id TEXT, period TEXT, date TEXT, 
+                load REAL, pv_production REAL, grid_load REAL, grid_feed REAL, battery_load REAL, battery_feed REAL,
+                PRIMARY KEY (station_id, period, date) )""" )
+            # cached aggregates; invalidated whenever underlying data is stored
+            rebuild = self.db.execute( "PRAGMA user_version" ).fetchone()[0] < AGGREGATE_VERSION
+            for table, key in [ ("day_aggregate", "date"), ("month_aggregate", "month") ]:
+                if rebuild:
+                    self.db.execute( "DROP TABLE IF EXISTS {}".format(table) )
+                self.db.execute( """CREATE TABLE IF NOT EXISTS {} (
+                    station_id TEXT, {} TEXT, 
+                    pv_production REAL, load REAL, grid_load REAL, grid_feed REAL, battery_load REAL, battery_feed REAL,
+                    peak_load REAL, peak_load_ts TEXT, days INTEGER, usage_pv_production REAL, usage_load REAL,
+                    PRIMARY KEY (station_id, {}) )""".format(table, key, key) )
+            if rebuild:
+                self.db.execute( "PRAGMA user_version={:d}".format(AGGREGATE_VERSION) )
+            # received 5 min slots per station and day (bitmap of SLOTS_PER_DAY bits) and no. of fetches
+            self.db.execute( """CREATE TABLE IF NOT EXISTS day_coverage (
+                station_id TEXT, date TEXT, bitmap BLOB, received INTEGER, fetches INTEGER, last_fetch TEXT,
+                PRIMARY KEY (station_id, date) )""" )
+            # no. of (gap re-)fetches of days with missing daily bar chart row
+            self.db.execute( """CREATE TABLE IF NOT EXISTS usage_fetches (
+                station_id TEXT, date TEXT, fetches INTEGER, last_fetch TEXT,
+                PRIMARY KEY (station_id, date) )""" )
+
+    #-------------------------------------------------
+    def close( self ):
+        with self._lock:
+            self.db.close()
+
+    #-------------------------------------------------
+    def store_day( self, stationId, date, data, count_fetch=False ):
+        # data: list of day curve items as returned by MTECapi.query_usage_data( stationId, "day", date )
+        # (should also be called with an empty list, so that the fetch is recorded in the coverage).
+        # count_fetch: count as (gap re-)fetch towards COVERAGE_MAX_FETCHES
+        date_str = date.strftime("%Y-%m-%d")
+        data = units.normalize_rows( data, units.DAY_CURVE_UNITS )
+        rows = [ (str(stationId), date_str, i["ts"]) + tuple(i[f] for f in CURVE_FIELDS) for i in data ]
+        bitmap = 0
+        for i in data:
+            slot = slot_of( i["ts"] )
+            if slot is not None:
+                bitmap |= 1 << slot
+        with self._lock, self.db:
+            self.db.executemany( "INSERT OR REPLACE INTO day_curve VALUES (?,?,?,?,?,?,?,?)", rows )
+            self._invalidate_aggregates( str(stationId), [date_str] )
+            self._update_coverage( str(stationId), date_str, bitmap, count_fetch )
+
+    #-------------------------------------------------
+    def _update_coverage( self, stationId, date_str, bitmap, count_fetch ):
+        # merge newly received slots with the already stored ones
+        row = self.db.execute( "SELECT bitmap, fetches FROM day_coverage WHERE station_id=? AND date=?", (stationId, date_str) ).fetchone()
+        fetches = 1 if count_fetch else 0
+        if row:
+            bitmap |= int.from_bytes( row["bitmap"], "little" )
+            fetches += row["fetches"]
+        self.db.execute( "INSERT OR REPLACE INTO day_coverage VALUES (?,?,?,?,?,?)", 
+            (stationId, date_str, bitmap.to_bytes(SLOTS_PER_DAY//8, "little"), bin(bitmap).count("1"), fetches,
+             datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")) )
+
+    #-------------------------------------------------
+    def store_usage( self, stationId, durationType, data ):
+        # data: list of bar chart items as returned by MTECapi.query_usage_data( stationId, durationType, date )
+        period = USAGE_PERIODS[durationType]
+        rows = [ (str(stationId), period, i["date"]) + tuple(i[f] for f in USAGE_FIELDS) for i in data ]
+        with self._lock, self.db:
+            self.db.executemany( "INSERT OR REPLACE INTO usage VALUES (?,?,?,?,?,?,?,?,?)", rows )
+            if period == "day":
+                self._invalidate_aggregates( str(stationId), [ row[2] for row in rows ] )
+
+    #-------------------------------------------------
+    def _invalidate_aggregates( self, stationId, dates ):
+        self.db.executemany( "DELETE FROM day_aggregate WHERE station_id=? AND date=?", [ (stationId, d) for d in dates ] )
+        self.db.executemany( "DELETE FROM month_aggregate WHERE station_id=? AND month=?", 
+                            [ (stationId, m) for m in set(d[:7] for d in dates) ] )
+
+    #-------------------------------------------------
+    def get_day( self, stationId, start, end ):
+        # day curve items for start <= date <= end (dates as "YYYY-MM-DD")
+        with self._lock:
+            cur = self.db.execute( """SELECT date, ts, load, grid, PV, battery, SOC FROM day_curve 
+                WHERE station_id=? AND date>=? AND date<=? ORDER BY date, ts""", (str(stationId), start, end) )
+            return [ dict(row) for row in cur ]
+
+    #-------------------------------------------------
+    def get_usage( self, stationId, period, start, end ):
+        # bar chart items of given period ("day", "month" or "year") for start <= date <= end
+        with self._lock:
+            cur = self.db.execute( """SELECT date, load, pv_production, grid_load, grid_feed, battery_load, battery_feed 
+                FROM usage WHERE station_id=? AND period=? AND date>=? AND date<=? ORDER BY date""", 
+                (str(stationId), period, start, end) )
+            return [ dict(row) for row in cur ]
+
+    #-------------------------------------------------
+    def _update_day_aggregates( self, stationId, start, end ):
+        # aggregate all days in [start, end] which aren't cached yet: energy from the daily bar chart rows
+        # (PV production and load from the integrated 5 min curves, if missing), peak load from the curves
+        self.db.execute( """INSERT OR REPLACE INTO day_aggregate
+            SELECT :id, d.date, COALESCE(u.pv_production, c.pv_production), COALESCE(u.load, c.load), 
+                u.grid_load, u.grid_feed, u.battery_load, u.battery_feed, c.peak_load, c.peak_load_ts, 1,
+                u.pv_production, u.load
+            FROM ( SELECT date FROM usage WHERE station_id=:id AND period='day' AND date BETWEEN :start AND :end
+                   UNION SELECT date FROM day_curve WHERE station_id=:id AND date BETWEEN :start AND :end ) d
+            LEFT JOIN usage u ON u.station_id=:id AND u.period='day' AND u.date=d.date
+            LEFT JOIN ( SELECT date, MAX(load) AS peak_load, CASE WHEN ts LIKE '____-__-__%' THEN ts ELSE date || ' ' || ts END AS peak_load_ts,
+                            SUM(PV)/12000.0 AS pv_production, SUM(load)/12000.0 AS load
+                        FROM day_curve WHERE station_id=:id AND date BETWEEN :start AND :end GROUP BY date ) c 
+                ON c.date=d.date
+            WHERE d.date NOT IN ( SELECT date FROM day_aggregate WHERE station_id=:id AND date BETWEEN :start AND :end )""",
+            { "id": stationId, "start": start, "end": end } )
+
+    #-------------------------------------------------
+    def _update_month_aggregates( self, stationId, start, end ):
+        self.db.execute( """INSERT OR REPLACE INTO month_aggregate
+            SELECT :id, substr(date, 1, 7) AS month, SUM(pv_production), SUM(load), SUM(grid_load), SUM(grid_feed), 
+                SUM(battery_load), SUM(battery_feed), MAX(peak_load), peak_load_ts, SUM(days),
+                SUM(usage_pv_production), SUM(usage_load)
+            FROM day_aggregate WHERE station_id=:id AND date BETWEEN :start AND :end 
+                AND substr(date, 1, 7) NOT IN ( SELECT month FROM month_aggregate WHERE station_id=:id )
+            GROUP BY month""", { "id": stationId, "start": start, "end": end } )
+
+    #-------------------------------------------------
+    def get_aggregates( self, stationId, start, end ):
+        # aggregated values (see AGGREGATE_FIELDS) per day or month covering start <= date <= end ("YYYY-MM-DD").
+        # Complete months are read from the cached month aggregates, the remaining days from the day aggregates.
+        # Today (and later) is never cached, as its data is still incomplete.
+        stationId = str(stationId)
+        today = datetime.date.today()
+        start_date = datetime.date.fromisoformat( start )
+        end_date = datetime.date.fromisoformat( end )
+        # first day of the first complete month and first day after the last complete month
+        first = start_date if start_date.day == 1 else (start_date.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        last = (end_date + datetime.timedelta(days=1)).replace(day=1)
+        last = min( last, today.replace(day=1) )
+        fields = ", ".join( AGGREGATE_FIELDS )
+        with self._lock, self.db:
+            self.db.execute( "DELETE FROM day_aggregate WHERE station_id=? AND date>=?", (stationId, today.isoformat()) )
+            self.db.execute( "DELETE FROM month_aggregate WHERE station_id=? AND month>=?", (stationId, today.isoformat()[:7]) )
+            self._update_day_aggregates( stationId, start, end )
+            rows = []
+            if first < last:
+                self._update_month_aggregates( stationId, first.isoformat(), (last - datetime.timedelta(days=1)).isoformat() )
+                rows += self.db.execute( "SELECT month AS date, {} FROM month_aggregate WHERE station_id=? AND month>=? AND month<?".format(fields),
+                                        (stationId, first.isoformat()[:7], last.isoformat()[:7]) ).fetchall()
+                rows += self.db.execute( "SELECT date, {} FROM day_aggregate WHERE station_id=? AND ((date>=? AND date<?) OR (date>=? AND date<=?))".format(fields),
+                                        (stationId, start, first.isoformat(), last.isoformat(), end) ).fetchall()
+            else:
+                rows += self.db.execute( "SELECT date, {} FROM day_aggregate WHERE station_id=? AND date>=? AND date<=?".format(fields),
+                                        (stationId, start, end) ).fetchall()
+        return sorted( [ dict(row) for row in rows ], key=lambda row: row["date"] )
+
+    #-------------------------------------------------
+    def get_coverage( self, stationId, start, end ):
+        # coverage of the day curves per day for start <= date <= end (also for days never fetched)
+        with self._lock:
+            cur = self.db.execute( "SELECT date, received, fetches, last_fetch FROM day_coverage WHERE station_id=? AND date>=? AND date<=?",
+                                   (str(stationId), start, end) )
+            stored = { row["date"]: dict(row) for row in cur }
+        result = []
+        for date in _date_range( start, end ):
+            item = stored.get( date, { "date": date, "received": 0, "fetches": 0, "last_fetch": None } )
+            item["expected"] = SLOTS_PER_DAY
+            item["complete"] = item["received"] >= SLOTS_PER_DAY
+            result.append( item )
+        return result
+
+    #-------------------------------------------------
+    def get_missing_usage_dates( self, stationId, start, end, max_fetches=None ):
+        # dates in start <= date <= end without daily bar chart row 
+        # (only those fetched less than max_fetches times, if given)
+        with self._lock:
+            cur = self.db.execute( "SELECT date FROM usage WHERE station_id=? AND period='day' AND date>=? AND date<=?",
+                                   (str(stationId), start, end) )
+            stored = set( row["date"] for row in cur )
+            if max_fetches is not None:
+                cur = self.db.execute( "SELECT date FROM usage_fetches WHERE station_id=? AND date>=? AND date<=? AND fetches>=?",
+                                       (str(stationId), start, end, max_fetches) )
+                stored.update( row["date"] for row in cur )
+        return [ date for date in _date_range(start, end) if date not in stored ]
+
+    #-------------------------------------------------
+    def get_missing_usage_months( self, stationId, start, end, max_fetches=None ):
+        # months ("YYYY-MM") for which not all daily bar chart rows in start <= date <= end are stored
+        return sorted( set( date[:7] for date in self.get_missing_usage_dates(stationId, start, end, max_fetches) ) )
+
+    #-------------------------------------------------
+    def record_usage_fetch( self, stationId, dates ):
+        # count a fetch of the month data for dates which were missing
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock, self.db:
+            self.db.executemany( """INSERT INTO usage_fetches VALUES (?,?,1,?)
+                ON CONFLICT (station_id, date) DO UPDATE SET fetches=fetches+1, last_fetch=excluded.last_fetch""",
+                [ (str(stationId), date, now) for date in dates ] )
+
+    #-------------------------------------------------
+    def get_station_ids( self ):
+        with self._lock:
+            return [ row[0] for row in self.db.execute( "SELECT DISTINCT station_id FROM usage UNION SELECT DISTINCT station_id FROM day_curve" ) ]
+
+#-------------------------------------------------
+def slot_of( ts ):
+    # index of the 5 min slot of a day curve timestamp (e.g. "2023-05-01 13:05:00" or "13:05")
+    match = _TIME_RE.search( str(ts) )
+    if match:
+        slot = (int(match.group(1)) * 60 + int(match.group(2))) // 5
+        if slot < SLOTS_PER_DAY:
+            return slot
+    return None
+
+#-------------------------------------------------
+def _date_range( start, end ):
+    date = datetime.date.fromisoformat( start )
+    end_date = datetime.date.fromisoformat( end )
+    while date <= end_date:
+        yield date.isoformat()
+        date += datetime.timedelta(days=1)
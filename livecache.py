@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Thread-safe in-memory cache of the latest station and device data.
+It is filled by the poller and read by local consumers (e.g. HTTP API); listeners
+(e.g. the shared-memory table) are notified of every change.
+(c) 2023 by Christian Rödel
+"""
+import threading
+import time
+
+#-------------------------------------------------
+class LiveCache:
+    #-------------------------------------------------
+    def __init__( self ):
+        self._data = {}
+        self._lock = threading.Lock()
+        self._listeners = []
+
+    #-------------------------------------------------
+    def add_listener( self, func ):
+        # func( kind, id, entry ) is called after each update (entry is None if removed)
+        self._listeners.append( func )
+
+    #-------------------------------------------------
+    def _notify( self, kind, id, entry ):
+        for func in self._listeners:
+            func( kind, str(id), entry )
+
+    #-------------------------------------------------
+    def update( self, kind, id, data, name=None ):
+        # kind: "station" or "device"
+        entry = { "ts": time.time(), "stale": False, "name": name, "data": data }
+        with self._lock:
+            self._data[(kind, str(id))] = entry
+        self._notify( kind, id, entry )
+
+    #-------------------------------------------------
+    def mark_stale( self, kind, id ):
+        with self._lock:
+            entry = self._data.get( (kind, str(id)) )
+            if entry:
+                entry = self._data[(kind, str(id))] = dict( entry, stale=True )
+        if entry:
+            self._notify( kind, id, entry )
+
+    #-------------------------------------------------
+    def get( self, kind, id ):
+        # entries are replaced (never modified) on update, so they can be returned without copying
+        with self._lock:
+            return self._data.get( (kind, str(id)) )
+
+    #-------------------------------------------------
+    def on_topology_change( self, event ):
+        # topology change (applied by the poller, see MTEC_mqtt.poll_cycle): drop data of removed stations/devices
+        # (renamed ones keep their entry - the poller updates the name with the next values)
+        if event["event"] == "remove":
+            self.remove( event["kind"], event["id"] )
+
+    #-------------------------------------------------
+    def remove( self, kind, id ):
+        with self._lock:
+            self._data.pop( (kind, str(id)), None )
+        self._notify( kind, id, None )
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Minimal cron-like job scheduler for long-running M-TEC services.
+Jobs are defined by a 5-field cron expression ("minute hour day month weekday"),
+never overlap with themselves and persist their last-run state to a JSON file.
+(c) 2023 by Christian Rödel
+"""
+import logging
+import threading
+import json
+import os
+import time
+from datetime import datetime, timedelta
+
+#-------------------------------------------------
+class CronSchedule:
+    # (min, max) per field: minute, hour, day of month, month, day of week (0=Sunday)
+    RANGES = [ (0, 59), (0, 23), (1, 31), (1, 12), (0, 6) ]
+
+    #-------------------------------------------------
+    def __init__( self, expr ):
+        self.expr = expr
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError( "Invalid cron expression '{}': expecting 5 fields".format(expr) )
+        self.fields = [ self._parse_field(f, lo, hi) for f, (lo, hi) in zip(fields, self.RANGES) ]
+        # cron semantics: if day of month AND day of week are restricted, either one has to match
+        self.dom_any = fields[2] == "*"
+        self.dow_any = fields[4] == "*"
+
+    #-------------------------------------------------
+    def _parse_field( self, field, lo, hi ):
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/")
+                step = int(step)
+            if part == "*":
+                start, end = lo, hi
+            elif "-" in part:
+                start, end = [ int(x) for x in part.split("-") ]
+            else:
+                start = int(part)
+                end = hi if step > 1 else start
+            if hi == 6 and end == 7:    # allow 7 as alias for Sunday
+                values.add(0)
+                end = 6
+                if start == 7:
+                    continue
+            if start < lo or end > hi or start > end or step < 1:
+                raise ValueError( "Invalid cron field '{}' (allowed range {}-{})".format(field, lo, hi) )
+            values.update( range(start, end+1, step) )
+        return values
+
+    #-------------------------------------------------
+    def matches( self, dt ):
+        minute, hour, dom, month, dow = self.fields
+        if dt.minute not in minute or dt.hour not in hour or dt.month not in month:
+            return False
+        dom_match = dt.day in dom
+        dow_match = (dt.isoweekday() % 7) in dow
+        if self.dom_any or self.dow_any:
+            return dom_match and dow_match
+        return dom_match or dow_match
+
+    #-------------------------------------------------
+    def prev_fire( self, dt, max_days=31 ):
+        # latest point in time <= dt (minute resolution) matching the schedule
+        dt = dt.replace( second=0, microsecond=0 )
+        limit = dt - timedelta(days=max_days)
+        while dt > limit:
+            if self.matches(dt):
+                return dt
+            dt -= timedelta(minutes=1)
+        return None
+
+#-------------------------------------------------
+class Scheduler:
+    #-------------------------------------------------
+    def __init__( self, state_file ):
+        self.state_file = state_file
+        self.jobs = {}
+        self.state = self._load_state()
+        self.state_lock = threading.Lock()
+
+    #-------------------------------------------------
+    def _load_state( self ):
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            logging.warning( "Couldn't read scheduler state file {}: {}".format(self.state_file, str(err)) )
+            return {}
+
+    #-------------------------------------------------
+    def _save_state( self ):
+        tmp_file = self.state_file + ".tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump( self.state, f, indent=2 )
+            os.replace( tmp_file, self.state_file )
+        except OSError as err:
+            logging.error( "Couldn't write scheduler state file {}: {}".format(self.state_file, str(err)) )
+
+    #-------------------------------------------------
+    def add_job( self, name, schedule, func, catchup=True ):
+        # catchup: run once at startup if the last scheduled run was missed (e.g. service was down)
+        self.jobs[name] = {
+            "schedule": CronSchedule(schedule),
+            "func": func,
+            "lock": threading.Lock(),
+            "catchup": catchup
+        }
+        logging.info( "Scheduled job '{}': {}".format(name, schedule) )
+
+    #-------------------------------------------------
+    def _last_run( self, name ):
+        last_run = self.state.get(name, {}).get("last_run")
+        if last_run:
+            return datetime.strptime( last_run, "%Y-%m-%d %H:%M" )
+
+    #-------------------------------------------------
+    def _run_job( self, name, fire_time ):
+        job = self.jobs[name]
+        if not job["lock"].acquire( blocking=False ):
+            logging.warning( "Job '{}' is still running - skipping run at {}".format(name, fire_time) )
+            return
+        try:
+            with self.state_lock:
+                self.state.setdefault(name, {})["last_run"] = fire_time.strftime("%Y-%m-%d %H:%M")
+                self._save_state()
+            logging.info( "Job '{}' started".format(name) )
+            start = time.monotonic()
+            try:
+                job["func"]()
+                status = "ok"
+            except Exception as err:
+                logging.exception( "Job '{}' failed: {}".format(name, str(err)) )
+                status = "error: {}".format(str(err))
+            duration = time.monotonic() - start
+            logging.info( "Job '{}' finished after {:.1f}s ({})".format(name, duration, status) )
+            with self.state_lock:
+                self.state[name].update( { "last_status": status, "last_duration": round(duration, 1),
+                    "last_finished": datetime.now().strftime("%Y-%m-%d %H:%M:%S") } )
+                self._save_state()
+        finally:
+            job["lock"].release()
+
+    #-------------------------------------------------
+    def trigger( self, name, fire_time=None ):
+        # run job in its own thread; a still running instance of the same job prevents the new run
+        if fire_time is None:
+            fire_time = datetime.now().replace( second=0, microsecond=0 )
+        t = threading.Thread( target=self._run_job, args=(name, fire_time), name="job-"+name, daemon=True )
+        t.start()
+        return t
+
+    #-------------------------------------------------
+    def run_catchup( self, now=None ):
+        if now is None:
+            now = datetime.now()
+        for name, job in self.jobs.items():
+            last_run = self._last_run(name)
+            if job["catchup"] and last_run:
+                prev = job["schedule"].prev_fire(now)
+                if prev and prev > last_run:
+                    logging.info( "Job '{}' missed its run at {} - catching up".format(name, prev) )
+                    self.trigger( name, prev )
+
+    #-------------------------------------------------
+    def run_pending( self, now=None ):
+        if now is None:
+            now = datetime.now()
+        now = now.replace( second=0, microsecond=0 )
+        for name, job in self.jobs.items():
+            if job["schedule"].matches(now) and self._last_run(name) != now:
+                self.trigger( name, now )
+
+    #-------------------------------------------------
+    def run_forever( self, stop_event ):
+        self.run_catchup()
+        while not stop_event.is_set():
+            self.run_pending()
+            # wake up shortly after the start of the next minute
+            stop_event.wait( 60 - datetime.now().second + 1 )
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""
+Shared-memory table of the latest station and device values.
+The poller writes into a memory-mapped file with a fixed layout; any process on the same host can
+read consistent snapshots without sockets and without querying the M-TEC portal.
+Every slot is protected by a sequence counter (seqlock): the writer makes it odd while writing and
+even again afterwards, readers retry if the counter was odd or changed while reading.
+(c) 2023 by Christian Rödel
+"""
+import mmap
+import os
+import struct
+import math
+import time
+
+MAGIC = b"MTECSHM1"
+LAYOUT_VERSION = 2
+HEADER = struct.Struct( "<8sIIII" )            # magic, version, n_slots, slot_size, max_values
+GENERATION = HEADER.size // 4                   # uint32 index of the generation (bumped on each start of the writer)
+HEADER_SIZE = 64
+SLOT_INFO = struct.Struct( "<d8s32s64sII" )     # timestamp, kind, id, name, n_values, stale
+SLOT_HEADER_SIZE = 8 + SLOT_INFO.size           # uint32 sequence counter (+ padding), slot info
+VALUE = struct.Struct( "<32sd" )                # parameter name, value
+# The sequence counters (native byte order) are accessed via a uint32 memoryview: an aligned 4 byte store is atomic,
+# whereas struct.pack_into() clears the target bytes before writing them.
+
+#-------------------------------------------------
+def _str( raw ):
+    return raw.split( b"\0", 1 )[0].decode( "utf-8", "replace" )
+
+#-------------------------------------------------
+def _numeric( data ):
+    # numeric value of a pvdata entry ({ "value", "unit" } dict or bare value); NaN if not numeric
+    if isinstance(data, dict):
+        data = data.get( "value" )
+    if isinstance(data, (int, float)):
+        return float(data)
+    return math.nan
+
+#-------------------------------------------------
+class ShmWriter:
+    # single writer: must only be used by one thread (the poller, via LiveCache listener)
+    #-------------------------------------------------
+    def __init__( self, fname, n_slots=64, max_values=64 ):
+        self.fname = fname
+        self.n_slots = n_slots
+        self.max_values = max_values
+        self.slot_size = SLOT_HEADER_SIZE + max_values * VALUE.size
+        self.slots = {}     # (kind, id) -> slot no.
+        size = HEADER_SIZE + n_slots * self.slot_size
+        # The file is reused (never truncated/shrunk), so that open readers don't lose their mapping.
+        # They notice the new generation and re-read the layout and slot assignment.
+        generation = 1
+        fd = os.open( fname, os.O_RDWR | os.O_CREAT, 0o644 )
+        try:
+            if os.fstat( fd ).st_size < size:
+                os.ftruncate( fd, size )
+            self.mm = mmap.mmap( fd, size )
+        finally:
+            os.close( fd )
+        self.seq = memoryview( self.mm ).cast( "I" )
+        if HEADER.unpack_from( self.mm, 0 )[0] == MAGIC:
+            generation = (self.seq[GENERATION] + 1) & 0xFFFFFFFF
+        self.mm[HEADER_SIZE:] = bytes( size - HEADER_SIZE )
+        HEADER.pack_into( self.mm, 0, MAGIC, LAYOUT_VERSION, n_slots, self.slot_size, max_values )
+        self.seq[GENERATION] = generation
+
+    #-------------------------------------------------
+    def close( self ):
+        self.seq.release()
+        self.mm.close()
+
+    #-------------------------------------------------
+    def _bump( self, i_seq ):
+        # increment a sequence counter (skipping 0, which marks an unused slot)
+        self.seq[i_seq] = (self.seq[i_seq] + 1) & 0xFFFFFFFF or 2
+
+    #-------------------------------------------------
+    def _slot( self, kind, id ):
+        key = (kind, str(id))
+        if key not in self.slots:
+            if len(self.slots) >= self.n_slots:
+                return None
+            self.slots[key] = len(self.slots)
+        return HEADER_SIZE + self.slots[key] * self.slot_size
+
+    #-------------------------------------------------
+    def update( self, kind, id, name, pvdata, stale=False, ts=None ):
+        offset = self._slot( kind, id )
+        if offset is None:
+            return False
+        items = list( pvdata.items() )[:self.max_values] if pvdata else []
+        i_seq = offset // 4
+        self._bump( i_seq )     # odd: write in progress
+        for i, (param, data) in enumerate(items):
+            VALUE.pack_into( self.mm, offset + SLOT_HEADER_SIZE + i * VALUE.size, param.encode("utf-8")[:32], _numeric(data) )
+        SLOT_INFO.pack_into( self.mm, offset + 8, ts or time.time(), kind.encode()[:8], str(id).encode()[:32],
+                             name.encode("utf-8")[:64], len(items), int(stale) )
+        self._bump( i_seq )     # even: consistent again
+        return True
+
+    #-------------------------------------------------
+    def mark_stale( self, kind, id ):
+        # flag the last values of a slot as stale (keeping the values)
+        key = (kind, str(id))
+        if key not in self.slots:
+            return
+        offset = HEADER_SIZE + self.slots[key] * self.slot_size
+        self._bump( offset // 4 )
+        struct.pack_into( "<I", self.mm, offset + SLOT_HEADER_SIZE - 4, 1 )
+        self._bump( offset // 4 )
+
+    #-------------------------------------------------
+    def on_cache_update( self, kind, id, entry ):
+        # LiveCache listener (values of removed entries are kept, but flagged as stale)
+        if entry is None or entry["stale"]:
+            self.mark_stale( kind, id )
+        else:
+            self.update( kind, id, entry.get("name") or str(id), entry["data"], ts=entry["ts"] )
+
+#-------------------------------------------------
+class ShmReader:
+    #-------------------------------------------------
+    def __init__( self, fname, max_retries=1000 ):
+        self.fname = fname
+        self.max_retries = max_retries
+        self._open()
+
+    #-------------------------------------------------
+    def _open( self ):
+        fd = os.open( self.fname, os.O_RDONLY )
+        try:
+            self.mm = mmap.mmap( fd, 0, access=mmap.ACCESS_READ )
+        finally:
+            os.close( fd )
+        magic, version, self.n_slots, self.slot_size, self.max_values = HEADER.unpack_from( self.mm, 0 )
+        if magic != MAGIC or version != LAYOUT_VERSION:
+            self.mm.close()
+            raise ValueError( "{} is no MTEC shared memory table (version {})".format(self.fname, LAYOUT_VERSION) )
+        self.seq = memoryview( self.mm ).cast( "I" )
+        self.generation = self.seq[GENERATION]
+        self.index = {}     # (kind, id or name) -> slot offset
+
+    #-------------------------------------------------
+    def _check_generation( self ):
+        # writer was restarted: slots are re-assigned and the layout may have changed
+        if self.seq[GENERATION] != self.generation:
+            self.close()
+            self._open()
+
+    #-------------------------------------------------
+    def close( self ):
+        self.seq.release()
+        self.mm.close()
+
+    #-------------------------------------------------
+    def _read_slot( self, offset, param=None, values=True ):
+        # consistent copy of a slot: (info tuple, values dict) or None if unused
+        i_seq = offset // 4
+        for _ in range(self.max_retries):
+            seq = self.seq[i_seq]
+            if seq == 0:
+                return None
+            if seq & 1:
+                time.sleep( 0 )     # let the writer finish (it may have been preempted while writing)
+                continue
+            info = SLOT_INFO.unpack_from( self.mm, offset + 8 )
+            data = {}
+            base = offset + SLOT_HEADER_SIZE
+            for i in range( min(info[4], self.max_values) if values else 0 ):
+                name, value = VALUE.unpack_from( self.mm, base + i * VALUE.size )
+                name = _str(name)
+                if param is None or name == param:
+                    data[name] = value
+            if self.seq[i_seq] == seq:
+                return info, data
+            time.sleep( 0 )
+        raise TimeoutError( "Couldn't read consistent snapshot" )
+
+    #-------------------------------------------------
+    def _entry( self, info, values ):
+        ts, kind, id, name, _, stale = info
+        return { "kind": _str(kind), "id": _str(id), "name": _str(name), "ts": ts, "stale": bool(stale), "data": values }
+
+    #-------------------------------------------------
+    def _find( self, kind, key ):
+        # slot offset of a station/device given by id or name
+        offset = self.index.get( (kind, key) )
+        if offset is not None:
+            return offset
+        for slot in range(self.n_slots):
+            offset = HEADER_SIZE + slot * self.slot_size
+            data = self._read_slot( offset, values=False )
+            if data is None:
+                break
+            _, k, id, name, _, _ = data[0]
+            if _str(k) == kind and key in (_str(id), _str(name)):
+                self.index[(kind, key)] = offset
+                return offset
+        return None
+
+    #-------------------------------------------------
+    def _lookup( self, kind, key, param=None ):
+        # consistent copy of the slot of a station/device given by id or name (None if unknown)
+        self._check_generation()
+        for _ in range(2):
+            offset = self._find( kind, key )
+            if offset is None:
+                return None
+            data = self._read_slot( offset, param )
+            if data:
+                _, k, id, name, _, _ = data[0]
+                if _str(k) == kind and key in (_str(id), _str(name)):
+                    return data
+            self.index = {}     # slot was re-assigned (or station/device renamed) - search again
+        return None
+
+    #-------------------------------------------------
+    def get( self, kind, key ):
+        # latest values of a station or device ("station" / "device", id or name)
+        data = self._lookup( kind, key )
+        return self._entry( *data ) if data else None
+
+    #-------------------------------------------------
+    def get_value( self, kind, key, param ):
+        data = self._lookup( kind, key, param )
+        return data[1].get( param ) if data else None
+
+    #-------------------------------------------------
+    def snapshot( self ):
+        self._check_generation()
+        result = []
+        for slot in range(self.n_slots):
+            data = self._read_slot( HEADER_SIZE + slot * self.slot_size )
+            if data is None:
+                break
+            result.append( self._entry(*data) )
+        return result
+
+#-------------------------------------------------
+if __name__ == "__main__":
+    import sys
+    from config import cfg
+    reader = ShmReader( sys.argv[1] if len(sys.argv) > 1 else cfg['SHM_FILE'] )
+    for entry in reader.snapshot():
+        print( "{} {} '{}' ({}){}".format( entry["kind"], entry["id"], entry["name"],
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["ts"])), " - stale" if entry["stale"] else "" ) )
+        for param, value in entry["data"].items():
+            print( "  {:24s} {}".format(param, value) )
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Measures the cold start time of the command line tools, e.g. to compare different hosts or versions.
+Each command is started N times as separate process; min and median wall-clock times are reported.
+(c) 2023 by Christian Rödel
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# label -> command line arguments (python interpreter is prepended)
+COMMANDS = {
+  "python (baseline)": [ "-c", "pass" ],
+  "import config": [ "-c", "import config" ],
+  "import MTECapi": [ "-c", "import MTECapi" ],
+  "export_data.py --help": [ "export_data.py", "--help" ],
+  "import MTEC_mqtt": [ "-c", "import MTEC_mqtt" ],
+  "import MTEC_client": [ "-c", "import MTEC_client" ],
+}
+
+#-----------------------------
+def measure( args, runs ):
+  times = []
+  for _ in range(runs):
+    start = time.perf_counter()
+    subprocess.run( [sys.executable] + args, cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False )
+    times.append( time.perf_counter() - start )
+  return min(times), statistics.median(times)
+
+#-----------------------------
+def show_importtime( args, count ):
+  # run once with "-X importtime" and show the most expensive imports (cumulative time)
+  result = subprocess.run( [sys.executable, "-X", "importtime"] + args, cwd=BASE_DIR,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=False )
+  imports = []
+  for line in result.stderr.splitlines():
+    if line.startswith("import time:") and "|" in line:
+      try:
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append( (int(cumulative), name.strip()) )
+      except ValueError:    # header line
+        pass
+  for cumulative, name in sorted(imports, reverse=True)[:count]:
+    print( "    {:8.1f} ms  {}".format(cumulative/1000, name) )
+
+#-----------------------------
+def main():
+  parser = argparse.ArgumentParser(description='Measures cold start time of the MTEC command line tools')
+  parser.add_argument( '-n', '--runs', type=int, default=10, help='No. of runs per command (default: 10)' )
+  parser.add_argument( '-i', '--importtime', type=int, default=0, metavar='N', help='Show the N most expensive imports per command' )
+  args = parser.parse_args()
+
+  print( "{:28s} {:>10s} {:>10s}".format("Command", "min [ms]", "median [ms]") )
+  for label, cmd in COMMANDS.items():
+    t_min, t_median = measure( cmd, args.runs )
+    print( "{:28s} {:10.1f} {:10.1f}".format(label, t_min*1000, t_median*1000) )
+    if args.importtime:
+      show_importtime( cmd, args.importtime )
+
+#-------------------------------
+if __name__ == '__main__':
+  main()
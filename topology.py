@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Topology watcher for M-TEC Energybutler.
+Re-reads stations and devices from the M-TEC portal (e.g. as scheduled daemon job) and notifies
+subscribers (MQTT bridge, caches, ...) of added, removed, renamed and updated stations/devices,
+so that they only need to re-plan the affected entities.
+(c) 2023 by Christian Rödel
+"""
+import logging
+
+#-----------------------------
+def _event( event, kind, id, station_id, data, old_data=None ):
+    return {
+        "event": event,               # "add", "remove", "rename" or "update"
+        "kind": kind,                 # "station" or "device"
+        "id": id,
+        "station_id": station_id,
+        "name": data["name"],
+        "old_name": old_data["name"] if old_data else None,
+        "data": data
+    }
+
+def _device_changes( station_id, old, new, events ):
+    # device events of one station; returns device dict (reusing unchanged device entries of old)
+    devices = {}
+    for device_id, device_data in old.items():
+        if device_id not in new:
+            events.append( _event("remove", "device", device_id, station_id, device_data) )
+    for device_id, device_data in new.items():
+        old_data = old.get( device_id )
+        if old_data is None:
+            events.append( _event("add", "device", device_id, station_id, device_data) )
+        elif old_data == device_data:
+            device_data = old_data
+        elif old_data["name"] != device_data["name"]:
+            events.append( _event("rename", "device", device_id, station_id, device_data, old_data) )
+        else:
+            events.append( _event("update", "device", device_id, station_id, device_data, old_data) )
+        devices[device_id] = device_data
+    return devices
+
+#-----------------------------
+def diff_topology( old, new ):
+    # Compares two topologies (see MTECapi.topology). Returns (events, topology), the latter reusing
+    # all unchanged station and device entries of old, so that per-entity state can be kept
+    events = []
+    topology = {}
+    for station_id, station_data in old.items():
+        if station_id not in new:
+            _device_changes( station_id, station_data["devices"], {}, events )
+            events.append( _event("remove", "station", station_id, station_id, station_data) )
+    for station_id, station_data in new.items():
+        old_data = old.get( station_id )
+        if old_data is None:
+            events.append( _event("add", "station", station_id, station_id, station_data) )
+            _device_changes( station_id, {}, station_data["devices"], events )
+        elif old_data == station_data:
+            station_data = old_data
+        else:
+            if old_data["name"] != station_data["name"]:
+                events.append( _event("rename", "station", station_id, station_id, station_data, old_data) )
+            station_data = dict( station_data, devices=_device_changes(station_id, old_data["devices"], station_data["devices"], events) )
+        topology[station_id] = station_data
+    return events, topology
+
+#-------------------------------------------------
+class TopologyWatcher:
+    #-------------------------------------------------
+    def __init__( self, api ):
+        self.api = api
+        self.subscribers = []
+
+    #-------------------------------------------------
+    def subscribe( self, func ):
+        # func( event ) is called for each change (see _event)
+        self.subscribers.append( func )
+
+    #-------------------------------------------------
+    def refresh( self ):
+        # re-read topology and notify subscribers; returns list of events (None on error)
+        topology = self.api.fetch_topology()
+        if topology is None:
+            logging.warning( "Couldn't refresh topology - keeping the known stations and devices" )
+            return None
+        events, topology = diff_topology( self.api.topology, topology )
+        if not events:
+            logging.debug( "Topology unchanged" )
+            return events
+        self.api.set_topology( topology )
+        for event in events:
+            if event["event"] == "rename":
+                logging.info( "Topology: {} {} renamed from '{}' to '{}'".format(event["kind"], event["id"], event["old_name"], event["name"]) )
+            else:
+                logging.info( "Topology: {} {} '{}' ({})".format(event["kind"], event["event"], event["name"], event["id"]) )
+            for func in self.subscribers:
+                try:
+                    func( event )
+                except Exception as e:
+                    logging.error( "Error while handling topology change: {}".format(str(e)) )
+        return events
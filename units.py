@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Unit normalization for M-TEC data.
+Power is normalized to W, energy to kWh. Source data is never modified; normalized copies are returned.
+(c) 2023 by Christian Rödel
+"""
+
+# source unit -> (normalized unit, factor)
+UNIT_FACTORS = {
+    "W":   ("W", 1),
+    "kW":  ("W", 1000),
+    "MW":  ("W", 1000000),
+    "GW":  ("W", 1000000000),
+    "Wh":  ("kWh", 0.001),
+    "kWh": ("kWh", 1),
+    "MWh": ("kWh", 1000),
+    "GWh": ("kWh", 1000000),
+}
+
+# Units of the day curves returned by MTECapi.query_usage_data() (the portal doesn't deliver them).
+# Bar chart data (month, year, lifetime) is in kWh already.
+DAY_CURVE_UNITS = { "load": "kW", "grid": "kW", "PV": "kW", "battery": "kW", "SOC": "%" }
+
+#-------------------------------------------------
+def normalize_value( value, unit ):
+    # returns (value, unit) converted to the normalized unit
+    target = UNIT_FACTORS.get( unit )
+    if target is None or not isinstance( value, (int, float) ) or isinstance( value, bool ):
+        return value, unit
+    return value * target[1], target[0]
+
+#-------------------------------------------------
+def normalize( data ):
+    # normalized copy of a { "value", "unit", ... } dict; anything else is returned as is
+    if isinstance(data, dict) and "value" in data and "unit" in data:
+        result = dict( data )
+        result["value"], result["unit"] = normalize_value( data["value"], data["unit"] )
+        return result
+    return data
+
+#-------------------------------------------------
+def normalize_rows( rows, units ):
+    # normalized copies of rows (list of dicts, e.g. day curves),
+    # converted in one pass with factors looked up once per field
+    factors = [ (field, UNIT_FACTORS[unit][1]) for field, unit in units.items()
+                if unit in UNIT_FACTORS and UNIT_FACTORS[unit][1] != 1 ]
+    result = []
+    for row in rows:
+        row = dict( row )
+        for field, factor in factors:
+            value = row.get( field )
+            if isinstance( value, (int, float) ):
+                row[field] = value * factor
+        result.append( row )
+    return result
+
+#-------------------------------------------------
+def denormalize_rows( rows, units, digits=6 ):
+    # inverse of normalize_rows (e.g. to export stored data in the units of the portal);
+    # values are rounded to <digits> decimal digits to get rid of floating point artefacts
+    factors = [ (field, UNIT_FACTORS[unit][1]) for field, unit in units.items()
+                if unit in UNIT_FACTORS and UNIT_FACTORS[unit][1] != 1 ]
+    result = []
+    for row in rows:
+        row = dict( row )
+        for field, factor in factors:
+            value = row.get( field )
+            if isinstance( value, (int, float) ):
+                row[field] = round( value / factor, digits )
+        result.append( row )
+    return result